@@ -1,14 +1,17 @@
 import os
 import posixpath
+import shutil
+import tempfile
 
 import boto3
 
 from runcommands import command
 from runcommands.commands import local, remote
-from runcommands.util import abort, printer
+from runcommands.util import abort, abs_path, printer
 
 from arctasks.static import build_static
-from arctasks.remote import copy_file, rsync
+from arctasks.remote import copy_file, copy_tree, rsync
+from arctasks.util import render_template
 
 from .provision import provision
 
@@ -67,8 +70,8 @@ def deploy(config, version=None, provision_=False, create_cert=False, overwrite=
             '/usr/bin/virtualenv-{python.version}',
             '-p /usr/bin/python{python.version}',
             '{deploy.venv}',
+            '&& {deploy.pip.exe} install --upgrade pip',
         ))
-        remote(config, '{deploy.pip.exe} install --upgrade pip')
 
     # Upload application source
     # TODO: Build a source dist and upload that instead
@@ -79,23 +82,39 @@ def deploy(config, version=None, provision_=False, create_cert=False, overwrite=
     # {deploy.dir}. Files with a relative destination path are copied to
     # {deploy.dir}/{destination}. Files that end with ".template" will
     # be copied as templates (i.e., config values will be injected).
-    for source, destination in config.deploy.copy_files.items():
-        source = source.format_map(config)
-        destination = destination.format_map(config)
-        deploy_dir = config.deploy.dir
-
-        source_base_name, ext = os.path.splitext(os.path.basename(source))
-        template = ext == '.template'
-
-        if destination:
-            if not posixpath.isabs(destination):
-                destination = posixpath.join(deploy_dir, destination)
-        else:
-            destination = deploy_dir
+    #
+    # Files that end up in {deploy.dir} are staged locally and copied in
+    # a single transfer. Files outside of it are copied individually.
+    deploy_dir = config.deploy.dir
+    with tempfile.TemporaryDirectory(prefix='{package}-'.format_map(config)) as staging_dir:
+        for source, destination in config.deploy.copy_files.items():
+            source = source.format_map(config)
+            destination = destination.format_map(config)
+
+            source_base_name, ext = os.path.splitext(os.path.basename(source))
+            template = ext == '.template'
+
+            if destination:
+                if not posixpath.isabs(destination):
+                    destination = posixpath.join(deploy_dir, destination)
+            else:
+                destination = posixpath.join(
+                    deploy_dir, source_base_name if template else os.path.basename(source))
+
+            if not destination.startswith(posixpath.join(deploy_dir, '')):
+                copy_file(config, source, destination, template=template)
+                continue
+
+            staged_path = os.path.join(
+                staging_dir, *posixpath.relpath(destination, deploy_dir).split('/'))
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
             if template:
-                destination = posixpath.join(destination, source_base_name)
+                with open(staged_path, 'w') as staged_file:
+                    staged_file.write(render_template(config, abs_path(source)))
+            else:
+                shutil.copy2(abs_path(source), staged_path)
 
-        copy_file(config, source, destination, template=template)
+        copy_tree(config, staging_dir, deploy_dir, default_excludes=False)
 
     remote(config, 'ln -sfn {local_settings_file} local.cfg', cd='{deploy.dir}')
 
@@ -122,8 +141,16 @@ def deploy(config, version=None, provision_=False, create_cert=False, overwrite=
         if static:
             remote(config, 'ln -sfn {deploy.dir}/staticfiles.json', cd='{deploy.static_dir}')
 
-    # Set permissions
-    remote(config, 'chmod -R ug=rwX,o=rX {deploy.root}')
+    # Set permissions. Only entries ug=rwX,o=rX would actually change
+    # are passed to chmod (user or group can't read/write, others can't
+    # read or can write, or it's a directory or executable file that
+    # isn't executable by everyone), so this doesn't touch every file in
+    # the tree on every deploy.
+    remote(config, (
+        'find {deploy.root}',
+        '\\( ! -perm -664 -o -perm /002 -o \\( \\( -type d -o -perm /111 \\) ! -perm -111 \\) \\)',
+        '-print0 | xargs -0 -r chmod ug=rwX,o=rX',
+    ))
 
     # Copying the uWSGI config file will cause the app's uWSGI process
     # to restart automatically.
@@ -51,8 +51,7 @@ def virtualenv(config, where, executable=None, overwrite=False):
             executable = 'python{v.major}.{v.minor}'.format(v=sys.version_info)
             printer.info('Automatically selected {executable} for virtualenv'.format_map(locals()))
         local(config, ('virtualenv', '-p', executable, where))
-        local(config, '{bin.pip} install -U setuptools')
-        local(config, '{bin.pip} install -U pip')
+        local(config, '{bin.pip} install -U setuptools pip')
 
 
 @command(default_env='dev')
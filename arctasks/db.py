@@ -1,11 +1,12 @@
 import os
+import subprocess
 from getpass import getpass
 from tempfile import mkstemp
 
 from runcommands import command
 from runcommands.config import Config
 from runcommands.commands import local
-from runcommands.util import abort, confirm
+from runcommands.util import abort, confirm, printer
 
 
 @command(default_env='dev')
@@ -45,27 +46,27 @@ def create_postgresql_db(config, user='{db.user}', host='{db.host}', port='{db.p
     result = local(config, 'id -u postgres', echo=False, hide='all', abort_on_failure=False)
     run_as = 'postgres' if result.succeeded else None
 
-    def run_command(*command, superuser='postgres', database='postgres'):
-        command = ' '.join(command)
-        command = '"{command}"'.format(command=command)
-        local(config, (
-            'psql',
-            '-U', superuser,
-            '-h', host,
-            '-p', port,
-            '-d', database,
-            '-c', command,
-        ), run_as=run_as, abort_on_failure=False)
+    user, host, port, name = (str(v).format_map(config) for v in (user, host, port, name))
 
-    run_command('CREATE USER', user, 'WITH SUPERUSER')
+    def run_commands(*commands, superuser='postgres', database='postgres'):
+        # The commands are fed to a single psql process on stdin so all
+        # of them are run over one connection. psql runs each statement
+        # separately and keeps going when one fails (e.g., when the user
+        # already exists). Multiple -c options aren't used because older
+        # versions of psql only run the last one.
+        args = ['psql', '-U', superuser, '-h', host, '-p', port, '-d', database]
+        statements = ''.join('{};\n'.format(' '.join(command)) for command in commands)
+        _run_client(args, run_as=run_as, input=statements)
 
+    commands = [('CREATE USER', user, 'WITH SUPERUSER')]
     if drop:
-        run_command('DROP DATABASE', name) if drop else None
-
-    run_command('CREATE DATABASE', name, 'WITH OWNER', user)
+        commands.append(('DROP DATABASE', name))
+    commands.append(('CREATE DATABASE', name, 'WITH OWNER', user))
+    run_commands(*commands)
 
-    for extension in extensions:
-        run_command('CREATE EXTENSION', extension, database=name)
+    if extensions:
+        run_commands(
+            *[('CREATE EXTENSION', extension) for extension in extensions], database=name)
 
 
 def create_mysql_db(config, user='{db.user}', host='{db.host}', port='{db.port}', name='{db.name}',
@@ -77,16 +78,10 @@ def create_mysql_db(config, user='{db.user}', host='{db.host}', port='{db.port}'
     development and testing.
 
     """
+    user, host, port, name = (str(v).format_map(config) for v in (user, host, port, name))
+
     def run_command(*command):
-        command = ' '.join(command)
-        command = '"{command}"'.format(command=command)
-        local(config, (
-            'mysql',
-            '-h', host,
-            '-p', port,
-            '-u', 'root',
-            '-e', command,
-        ), abort_on_failure=False)
+        _run_client(['mysql', '-h', host, '-P', port, '-u', 'root', '-e', ' '.join(command)])
 
     f = locals()
 
@@ -99,6 +94,28 @@ def create_mysql_db(config, user='{db.user}', host='{db.host}', port='{db.port}'
     run_command('CREATE DATABASE', name)
 
 
+def _run_client(args, run_as=None, input=None):
+    """Run a database client directly, without a shell.
+
+    SQL statements are passed to the client as single arguments or via
+    ``input`` (which is written to the client's stdin), so they don't
+    need to be quoted. Failures are ignored so callers can run
+    statements that might fail (e.g., creating a user that exists).
+
+    """
+    if run_as:
+        args = ['sudo', '-u', run_as] + args
+    printer.info(*args)
+    if input is not None:
+        printer.info(input, end='')
+    try:
+        process = subprocess.Popen(
+            args, stdin=(None if input is None else subprocess.PIPE), universal_newlines=True)
+    except FileNotFoundError:
+        abort(1, '{args[0]} not found'.format_map(locals()))
+    process.communicate(input)
+
+
 @command(default_env='dev')
 def load_prod_data(config,
                    reset=False,
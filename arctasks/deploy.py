@@ -1,14 +1,19 @@
+import hashlib
 import json
 import os
 import posixpath
+import re
+import shlex
 import shutil
 import ssl
-import string
+import subprocess
 import sys
 import tarfile
 import tempfile
-from configparser import ConfigParser, ExtendedInterpolation
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
 from urllib.error import HTTPError, URLError
 from urllib.request import urlopen, urlretrieve
 
@@ -19,9 +24,11 @@ from runcommands.util import abort, confirm, load_object, printer
 from . import django
 from . import git
 from .base import clean, install
-from .remote import manage as remote_manage, rsync, copy_file
+from .remote import (
+    cache_readlink, copy_file, copy_tree, forget_readlink, manage as remote_manage,
+    master_connection, readlink, rsync, ssh_options)
 from .static import build_static, collectstatic
-from .util import abs_path
+from .util import abs_path, list_files, render_template
 
 
 class Deployer:
@@ -62,14 +69,20 @@ class Deployer:
         self.options = self.init_options(config, options)
         self.config = config
         self.build_dir = config.path.build.root
+        # Source distributions are cached outside of the build directory
+        # so they can be reused by subsequent builds.
+        self.dist_cache_dir = os.path.join(os.path.dirname(self.build_dir), 'sdists')
         self.current_branch = git.current_branch()
 
         self.remote_build_root = config.remote.build.root
         self.remote_build_dir = config.remote.build.dir
 
-        archive_directory = os.path.dirname(self.build_dir)
-        archive_file_name = '{config.version}.tgz'.format_map(locals())
-        self.archive_path = os.path.join(archive_directory, archive_file_name)
+        # Remote commands that don't need to finish before the next step
+        # are run in the background; see run_in_background().
+        self.executor = None
+        self.background_tasks = []
+        self.remote_build_dir_removed = False
+        self.provision_task = None
 
     def init_options(self, config, options):
         remove_distributions = list(options.get('remove_distributions') or ())
@@ -79,12 +92,25 @@ class Deployer:
 
     def run(self):
         """Deploy."""
-        self.show_info()
-        self.confirm()
-        self.do_local_preprocessing()
-        if self.options['push']:
-            self.push()
-        self.do_remote_commands()
+        # Keep one SSH connection open for the duration of the deploy so
+        # connections made along the way don't have to authenticate.
+        with master_connection(self.config):
+            with ThreadPoolExecutor(max_workers=1) as self.executor:
+                self.show_info()
+                self.confirm()
+                if self.options['push'] and self.options['overwrite']:
+                    # Removing the existing remote build can take a while,
+                    # so it's done while the local build is being made.
+                    # The active build is left in place until it's pushed
+                    # over so the site isn't down for the whole build.
+                    active_path = readlink(self.config, '{remote.path.env}')
+                    if active_path != self.remote_build_dir:
+                        self.run_in_background(self.remove_remote_build_dir)
+                self.do_local_preprocessing()
+                if self.options['push']:
+                    self.push()
+                self.do_remote_commands()
+                self.wait_for_background_tasks()
         if git.current_branch() != self.current_branch:
             git.run(['checkout', self.current_branch])
 
@@ -93,9 +119,7 @@ class Deployer:
         config = self.config
         options = self.options
 
-        result = remote(
-            config, 'readlink {remote.path.env}', echo=False, hide='all', abort_on_failure=False)
-        active_path = result.stdout.strip()
+        active_path = readlink(config, '{remote.path.env}')
 
         printer.header('Preparing to deploy {name} to {env} ({remote.host})'.format_map(config))
         if active_path:
@@ -132,25 +156,111 @@ class Deployer:
             install(config)
 
         self.make_build_dir()
-        if self.options['build_static']:
-            self.build_static()
-        self.make_dists()
+        if options['provision']:
+            self.copy_virtualenv()
+            if options['push'] and self.executor is not None:
+                # The remote virtualenv only depends on virtualenv itself,
+                # so it's pushed and created while the local build is
+                # being made.
+                self.provision_task = self.executor.submit(self.push_virtualenv_and_provision)
+                self.background_tasks.append(self.provision_task)
+        # ARCTasks is downloaded and the source distributions for deps are
+        # made in the background while static files are being built. The
+        # project's source distribution is made afterwards since it may
+        # include compiled static assets.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            dists_made = self.make_dep_dists(executor)
+            if self.options['build_static']:
+                self.build_static()
+            self.make_dists()
+            for future in dists_made:
+                future.result()
         self.copy_files()
-        self.create_archive()
+        self.copy_cached_wheels()
+        self.write_wheels_key()
 
     def make_build_dir(self):
-        """Make the local build directory."""
+        """Make the local build directory.
+
+        By default, any existing build directory is removed first. When
+        the ``clean_build`` option is off, the existing static directory
+        is kept so that collecting static files only has to copy files
+        that have changed; everything else is still removed.
+
+        """
         build_dir = self.build_dir
         if os.path.isdir(build_dir):
-            printer.header(
-                'Removing existing build directory: {build_dir}...'.format_map(locals()))
-            shutil.rmtree(build_dir)
+            # Things being removed are moved out of the way into a trash
+            # directory next to the build directory, which is then
+            # deleted in the background.
+            trash_dir = tempfile.mkdtemp(prefix='.trash-', dir=os.path.dirname(build_dir))
+            if self.options['clean_build']:
+                printer.header(
+                    'Removing existing build directory: {build_dir}...'.format_map(locals()))
+                os.rename(build_dir, os.path.join(trash_dir, os.path.basename(build_dir)))
+            else:
+                printer.header(
+                    'Cleaning existing build directory (keeping static): {build_dir}...'
+                    .format_map(locals()))
+                for name in os.listdir(build_dir):
+                    if name != 'static':
+                        os.rename(os.path.join(build_dir, name), os.path.join(trash_dir, name))
+            # This isn't a daemon thread so the trash will be fully removed
+            # even if everything else finishes first.
+            threading.Thread(
+                target=shutil.rmtree, args=(trash_dir,), kwargs={'ignore_errors': True}).start()
         printer.header('Creating build directory: {build_dir}'.format_map(locals()))
-        os.makedirs(build_dir)
+        os.makedirs(build_dir, exist_ok=True)
         os.makedirs(os.path.join(build_dir, 'dist'))
-        os.makedirs(os.path.join(build_dir, 'static'))
+        os.makedirs(os.path.join(build_dir, 'static'), exist_ok=True)
         os.makedirs(os.path.join(build_dir, 'wsgi'))
 
+    def copy_virtualenv(self):
+        """Copy virtualenv into the build directory.
+
+        The remote virtualenv is created with this copy of virtualenv
+        (see :meth:`provision`).
+
+        """
+        config = self.config
+        build_dir = self.build_dir
+        # Download and copy virtualenv. The download is kept outside
+        # of the build directory so it can be reused by subsequent
+        # builds; it's keyed by version, so it only needs to be
+        # downloaded again when the virtualenv version changes.
+        tarball_path = os.path.join(
+            os.path.dirname(build_dir), config.virtualenv.tarball_name)
+        if os.path.isfile(tarball_path):
+            printer.info('Using previously downloaded {tarball_path}'.format_map(locals()))
+        else:
+            download_path = '{tarball_path}.part'.format_map(locals())
+            urlretrieve(config.virtualenv.download_url, download_path)
+            os.rename(download_path, tarball_path)
+        with tarfile.open(tarball_path, 'r') as tarball:
+            def is_within_directory(directory, target):
+                
+                abs_directory = os.path.abspath(directory)
+                abs_target = os.path.abspath(target)
+            
+                prefix = os.path.commonprefix([abs_directory, abs_target])
+                
+                return prefix == abs_directory
+            
+            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
+            
+                for member in tar.getmembers():
+                    member_path = os.path.join(path, member.name)
+                    if not is_within_directory(path, member_path):
+                        raise Exception("Attempted Path Traversal in Tar File")
+            
+                tar.extractall(path, members, numeric_owner=numeric_owner) 
+                
+            
+            safe_extract(tarball, build_dir)
+        os.rename(
+            os.path.join(build_dir, config.virtualenv.base_name),
+            os.path.join(build_dir, 'virtualenv'))
+
     def build_static(self):
         """Process static files and collect them.
 
@@ -161,19 +271,35 @@ class Deployer:
         printer.header('Building static files...')
         static_root = self.config.path.build.static_root
         build_static(self.config, collect=False)
-        collectstatic(self.config, static_root=static_root, hide='stdout')
+        collectstatic(
+            self.config, static_root=static_root, clear=self.options['clean_build'],
+            hide='stdout')
 
-    def make_dists(self):
-        printer.header('Making source distributions...')
+    def make_dep_dists(self, executor):
+        """Download ARCTasks and make source distributions for deps.
+
+        These are run using ``executor``. Each sdist is made by a
+        separate setup.py process, so they can be made concurrently.
+        Returns a list of futures.
+
+        """
         config = self.config
-        options = self.options
         dist_dir = config.path.build.dist
-        make_dist(config, '.', dist_dir=dist_dir)
-        for path in options['deps']:
-            make_dist(config, path, dist_dir)
-        urlretrieve(
+        os.makedirs(dist_dir, exist_ok=True)
+        futures = [executor.submit(
+            urlretrieve,
             'https://github.com/PSU-OIT-ARC/arctasks/archive/master.tar.gz',
-            os.path.join(dist_dir, 'psu.oit.arc.tasks-0.0.0.tar.gz'))
+            os.path.join(dist_dir, 'psu.oit.arc.tasks-0.0.0.tar.gz'))]
+        futures.extend(
+            executor.submit(make_dist, config, path, dist_dir, cache_dir=self.dist_cache_dir)
+            for path in self.options['deps'])
+        return futures
+
+    def make_dists(self):
+        """Make the project's source distribution."""
+        printer.header('Making source distributions...')
+        config = self.config
+        make_dist(config, '.', dist_dir=config.path.build.dist, cache_dir=self.dist_cache_dir)
 
     def copy_files(self):
         config = self.config
@@ -203,77 +329,220 @@ class Deployer:
             copy_file_local(config, 'commands.py', build_dir)
 
         if os.path.exists('commands.cfg'):
-            commands_config = ConfigParser(interpolation=ExtendedInterpolation())
             with open('commands.cfg') as commands_file:
-                commands_config.read_file(commands_file)
+                commands_config = commands_file.read()
             extra_config = {
                 'version': config.version,
                 'local_settings_file': config.remote.build.local_settings_file,
                 'deployed_at': self.started.isoformat(),
             }
             extra_config = {k: json.dumps(v) for (k, v) in extra_config.items()}
-            commands_config['DEFAULT'].update(extra_config)
-            temp_fd, temp_file = tempfile.mkstemp(text=True)
-            with os.fdopen(temp_fd, 'w') as t:
-                commands_config.write(t)
-            copy_file_local(config, temp_file, os.path.join(build_dir, 'commands.cfg'))
-
-        if self.options['provision']:
-            # Download and copy virtualenv
-            tarball_path = os.path.join(build_dir, 'virtualenv.tgz')
-            urlretrieve(config.virtualenv.download_url, tarball_path)
-            with tarfile.open(tarball_path, 'r') as tarball:
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tarball, build_dir)
-            os.remove(tarball_path)
-            os.rename(
-                os.path.join(build_dir, config.virtualenv.base_name),
-                os.path.join(build_dir, 'virtualenv'))
+            commands_config = set_default_config_values(commands_config, extra_config)
+            with open(os.path.join(build_dir, 'commands.cfg'), 'w') as commands_file:
+                commands_file.write(commands_config)
+
+    def copy_cached_wheels(self):
+        """Copy locally cached wheels for pinned requirements.
+
+        Pure Python wheels in the local pip wheel cache that match a
+        requirement pinned to an exact version are copied into the build
+        directory. The remote wheel build finds them there instead of
+        downloading and building them again. Platform specific wheels
+        are skipped since the local and remote platforms may differ.
 
-    def create_archive(self):
-        printer.header('Creating archive...')
-        with tarfile.open(self.archive_path, mode='w:gz') as tarball:
-            tarball.add(self.build_dir, self.config.version)
+        Wheels built from source distributions can have requirements
+        that depend on the Python version they were built with baked in,
+        so cached wheels are only used when the local virtualenv's Python
+        version is the same as the remote Python version.
+
+        """
+        config = self.config
+        wheels_dir = config.path.build.wheels
+        os.makedirs(wheels_dir, exist_ok=True)
+
+        local_python_version = subprocess.check_output(
+            [config.bin.python, '-c', 'import sys; print("%d.%d" % sys.version_info[:2])'],
+            universal_newlines=True).strip()
+        if local_python_version != config.remote.python.version:
+            return
+
+        cache_dir = config.pip.wheel_cache_dir
+        if cache_dir:
+            cache_dir = os.path.expanduser(cache_dir)
+        else:
+            # The location of pip's cache is platform specific, so pip is
+            # asked where it is. Older versions of pip don't have the
+            # cache command, in which case cached wheels aren't used.
+            try:
+                cache_dir = subprocess.check_output(
+                    [config.bin.pip, 'cache', 'dir'], stderr=subprocess.DEVNULL,
+                    universal_newlines=True).strip()
+            except subprocess.CalledProcessError:
+                return
+            cache_dir = os.path.join(cache_dir, 'wheels')
+        if not os.path.isdir(cache_dir):
+            return
+
+        requirements = set()
+        with open(os.path.join(self.build_dir, 'requirements.txt')) as fp:
+            for line in fp:
+                match = _pinned_requirement_re.match(line)
+                if match:
+                    name, version = match.groups()
+                    requirements.add((_normalize_dist_name(name), version))
+
+        python_tags = {'py3', 'py{}'.format(config.remote.python.version.replace('.', ''))}
+        copied = set()
+        for name in list_files(cache_dir):
+            file_name = os.path.basename(name)
+            if not file_name.endswith('-none-any.whl') or file_name in copied:
+                continue
+            parts = file_name[:-4].split('-')
+            if len(parts) not in (5, 6):
+                continue
+            dist_name, version, python_tag = parts[0], parts[1], parts[-3]
+            key = (_normalize_dist_name(dist_name), version)
+            if key in requirements and python_tags.intersection(python_tag.split('.')):
+                shutil.copy2(os.path.join(cache_dir, name), wheels_dir)
+                copied.add(file_name)
+
+        if copied:
+            printer.info('Copied {n} cached wheels to {wheels_dir}'.format(
+                n=len(copied), wheels_dir=wheels_dir))
+
+    # Files in the build directory (and in the remote wheel directory once
+    # wheels have been built) identifying the inputs to the wheel build.
+    # The first covers everything; the second excludes the project itself.
+    wheels_key_file_name = 'wheels.sha256'
+    deps_wheels_key_file_name = 'wheels-deps.sha256'
+
+    def write_wheels_key(self):
+        """Write hashes of the source distributions & requirements.
+
+        The hashes are copied into the remote wheel directory after
+        wheels are built so :meth:`wheels` can skip building them again
+        when neither the source distributions nor the requirements have
+        changed since the last deployment.
+
+        The second hash leaves out the project's source distribution and
+        its own requirement line, so when only the project has changed,
+        :meth:`wheels` can rebuild just the project's wheel. This is only
+        safe when the requirements are frozen (i.e., they list all of
+        the project's dependencies); otherwise, the second hash is the
+        same as the first.
+
+        """
+        config = self.config
+        build_dir = self.build_dir
+        dist_dir = config.path.build.dist
+        project_name = _normalize_dist_name(config.distribution)
+        frozen = os.path.isfile('requirements-frozen.txt')
+        wheels_key = hashlib.sha256()
+        deps_wheels_key = hashlib.sha256()
+
+        for name in sorted(os.listdir(dist_dir)):
+            keys = [wheels_key]
+            if not (frozen and _is_sdist_of(name, project_name)):
+                keys.append(deps_wheels_key)
+            for key in keys:
+                key.update(name.encode('utf-8'))
+            with open(os.path.join(dist_dir, name), 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                    for key in keys:
+                        key.update(chunk)
+
+        with open(os.path.join(build_dir, 'requirements.txt'), 'rb') as fp:
+            for line in fp:
+                wheels_key.update(line)
+                match = _requirement_name_re.match(line.decode('utf-8'))
+                if not (frozen and match and _normalize_dist_name(match.group(1)) == project_name):
+                    deps_wheels_key.update(line)
+
+        if not frozen:
+            deps_wheels_key = wheels_key
+        for file_name, key in (
+                (self.wheels_key_file_name, wheels_key),
+                (self.deps_wheels_key_file_name, deps_wheels_key)):
+            with open(os.path.join(build_dir, file_name), 'w') as fp:
+                fp.write('{}\n'.format(key.hexdigest()))
 
     def push(self):
-        printer.header('Pushing archive...')
+        """Push the build directory to the remote host.
+
+        When there's an active build on the remote host, the build
+        directory is rsync'ed relative to it, so only files that have
+        changed since the active build was deployed are transferred.
+        Unchanged files are hard linked to the active build's copies.
+        Since most of the build directory is regenerated for every build,
+        files are compared by checksum rather than by modification time.
+        Otherwise, the build directory is streamed to the remote host as
+        a single tar stream and extracted into the remote build root as
+        it's received.
+
+        """
+        printer.header('Pushing build...')
         config = self.config
         options = self.options
-        build_root = self.remote_build_root
         build_dir = self.remote_build_dir
 
         if self.options['overwrite']:
-            remote(config, ('rm -rf', build_dir), host='hrimfaxi.oit.pdx.edu')
-
-        copy_file(self.config, self.archive_path, self.config.remote.build.root, quiet=True)
-
-        remote(config, (
-            'tar xvf', os.path.basename(self.archive_path),
-        ), cd=build_root, hide='stdout')
+            # The remote build directory may be in the process of being
+            # removed in the background already.
+            self.wait_for_background_tasks()
+            if not self.remote_build_dir_removed:
+                self.remove_remote_build_dir()
+
+        # When virtualenv was already pushed by itself (see
+        # do_local_preprocessing()), it's left out here so it isn't sent
+        # again or overwritten while the remote virtualenv is being
+        # created from it.
+        virtualenv_pushed = self.provision_task is not None
+
+        active_path = readlink(config, '{remote.path.env}')
+        if active_path:
+            rsync(
+                config, os.path.join(self.build_dir, ''), build_dir, quiet=True, checksum=True,
+                excludes=('/virtualenv/',) if virtualenv_pushed else (),
+                link_dest=None if active_path == build_dir else active_path)
+        else:
+            copy_tree(
+                config, self.build_dir, self.remote_build_root, arcname=config.version,
+                excludes=('virtualenv/',) if virtualenv_pushed else ())
 
         if options['static']:
-            remote(config, (
-                'rsync -rlqtvz --exclude staticfiles.json static/ {remote.path.static}',
+            # Static files only need to be in place before the new
+            # version is made active, so they're copied into the shared
+            # static directory while the virtualenv is being built.
+            self.run_in_background(remote, config, (
+                'umask 007 &&',
+                'rsync -rlqt --exclude staticfiles.json static/ {remote.path.static}',
             ), cd=build_dir)
 
+    def remove_remote_build_dir(self):
+        """Remove the remote build directory (when overwriting)."""
+        remote(self.config, ('rm -rf', self.remote_build_dir), host='hrimfaxi.oit.pdx.edu')
+        self.remote_build_dir_removed = True
+
+    def run_in_background(self, func, *args, **kwargs):
+        """Run ``func`` in the background.
+
+        This is intended for remote commands that other steps don't
+        depend on (until the new version is made active). Background
+        tasks are waited on before :meth:`make_active` and at the end of
+        :meth:`run`. If there's no executor (i.e., when a step is called
+        outside of :meth:`run`), ``func`` is run immediately.
+
+        """
+        if self.executor is None:
+            return func(*args, **kwargs)
+        self.background_tasks.append(self.executor.submit(func, *args, **kwargs))
+
+    def wait_for_background_tasks(self):
+        """Wait for background tasks, re-raising any errors they raised."""
+        background_tasks, self.background_tasks = self.background_tasks, []
+        for task in background_tasks:
+            task.result()
+
     # Remote
 
     remote_commands = (
@@ -292,14 +561,36 @@ class Deployer:
                 getattr(self, remote_command)()
 
     def provision(self):
+        if self.provision_task is not None:
+            # Already started in the background while the local build
+            # was being made; see do_local_preprocessing().
+            self.provision_task.result()
+            return
+        self.make_virtualenv()
+
+    def push_virtualenv_and_provision(self):
+        """Push virtualenv by itself, then create the remote virtualenv."""
+        copy_tree(
+            self.config, os.path.join(self.build_dir, 'virtualenv'), self.remote_build_dir,
+            arcname='virtualenv', quiet=True)
+        self.make_virtualenv()
+
+    def make_virtualenv(self):
         printer.header('Provisioning...')
         remote(self.config, (
+            'umask 007 &&',
             'test -d {remote.build.venv} ||',
             '{remote.bin.python} {remote.build.dir}/virtualenv/virtualenv.py',
             '-p python{python.version}',
             '{remote.build.venv}'
         ))
 
+    # Exit codes used to signal that the project's source distribution
+    # wasn't found on the remote host when building wheels and that the
+    # wheels built by the previous deployment are up to date.
+    missing_sdist_exit_code = 42
+    wheels_up_to_date_exit_code = 43
+
     def wheels(self):
         """Build and cache packages (as wheels)."""
         printer.header('Building wheels...')
@@ -310,17 +601,86 @@ class Deployer:
         for dist in options['remove_distributions']:
             path = '/'.join((wheel_dir, '{dist}*'.format(dist=dist.replace('-', '_'))))
             paths_to_remove.append(path)
-        remote(config, ('rm -f', paths_to_remove))
-        remote(config, (
-            'LANG=en_US.UTF-8',
+        # Setuptools may or may not normalize dashes in the sdist name.
+        distribution = config.distribution
+        sdist_paths = [
+            posixpath.join(config.remote.build.dist, '{name}*'.format(name=name))
+            for name in sorted({distribution, distribution.replace('-', '_')})
+        ]
+        # env is used so this also works as the command run by xargs.
+        pip_wheel = (
+            'env LANG=en_US.UTF-8',
             '{remote.build.pip} wheel',
             '--wheel-dir {remote.pip.wheel_dir}',
             '--cache-dir {remote.pip.cache_dir}',
             '--find-links {remote.build.dist}',
+            '--find-links {remote.build.wheels}',
             '--find-links {remote.pip.find_links}',
             '--disable-pip-version-check',
-            '-r {remote.build.dir}/requirements.txt',
-        ))
+        )
+        # When building wheels with multiple jobs, the requirements are
+        # first built concurrently without their dependencies, one pip
+        # process per requirement. The regular build below then only has
+        # to build wheels for dependencies that aren't already cached.
+        # Comments, blank lines, and options are stripped from the
+        # requirements passed to xargs.
+        wheel_jobs = int(options['wheel_jobs'] or 1)
+        if wheel_jobs > 1:
+            build_requirements = (
+                "sed -E -e 's/(^|[[:space:]])#.*$//' -e 's/^[[:space:]]+|[[:space:]]+$//g'",
+                "-e '/^(-|$)/d' {remote.build.dir}/requirements.txt |",
+                'xargs -d "\\n" -r -n 1 -P', str(wheel_jobs), pip_wheel, '--no-deps', '&&',
+            )
+        else:
+            build_requirements = ()
+        remote_build_dir = config.remote.build.dir
+        wheels_key_path = posixpath.join(remote_build_dir, self.wheels_key_file_name)
+        deps_wheels_key_path = posixpath.join(remote_build_dir, self.deps_wheels_key_file_name)
+        # Wheels are always rebuilt when distributions other than the
+        # project's are explicitly removed. Otherwise, if nothing has
+        # changed, the build is skipped entirely, and if only the project
+        # has changed, only its wheel is rebuilt.
+        if options['remove_distributions'] == [distribution]:
+            check_wheels_key = (
+                'cmp -s', wheels_key_path, posixpath.join(wheel_dir, self.wheels_key_file_name),
+                '&& exit', str(self.wheels_up_to_date_exit_code), ';',
+            )
+            check_deps_wheels_key = (
+                'cmp -s', deps_wheels_key_path,
+                posixpath.join(wheel_dir, self.deps_wheels_key_file_name),
+            )
+        else:
+            check_wheels_key = ()
+            check_deps_wheels_key = 'false'
+        # Checking whether wheels need to be built, checking for the
+        # project's source distribution, removing stale wheels, building
+        # new wheels, and recording what they were built from are run as
+        # a single remote command to avoid extra round trips to the
+        # remote host.
+        result = remote(config, (
+            check_wheels_key,
+            # Unmatched globs are left as is by the shell, so this only
+            # succeeds if at least one of them matched something. $path
+            # is left pointing at the source distribution.
+            'for path in', sdist_paths, '; do test -e "$path" && break; done ||',
+            'exit', str(self.missing_sdist_exit_code), '&&',
+            'rm -f', paths_to_remove, '&&',
+            'if', check_deps_wheels_key, '; then',
+            pip_wheel, '--no-deps "$path" ;',
+            'else',
+            build_requirements,
+            pip_wheel,
+            '-r {remote.build.dir}/requirements.txt ;',
+            'fi &&',
+            'cp', wheels_key_path, deps_wheels_key_path, wheel_dir,
+        ), abort_on_failure=False)
+        if result.return_code == self.wheels_up_to_date_exit_code:
+            printer.info('Source distributions and requirements unchanged; reusing wheels')
+        elif result.return_code == self.missing_sdist_exit_code:
+            abort(1, 'Source distribution for {distribution} not found in {remote.build.dist}'
+                     .format_map(config))
+        elif result.failed:
+            abort(result.return_code, 'Failed to build wheels')
 
     def install(self):
         """Install new version in deployment environment."""
@@ -328,14 +688,21 @@ class Deployer:
         config = self.config
         options = self.options
 
-        uninstall_commands = []
-        for dist in options['remove_distributions']:
-            uninstall_commands.append(
-                '{config.remote.build.pip} uninstall -y {dist}'.format_map(locals()))
-        if uninstall_commands:
-            remote(config, '; '.join(uninstall_commands), abort_on_failure=False)
+        # Uninstall all distributions with a single pip process. Older
+        # versions of pip stop at the first distribution that isn't
+        # installed, so fall back to uninstalling them one at a time.
+        remove_distributions = options['remove_distributions']
+        if remove_distributions:
+            uninstall = '{config.remote.build.pip} uninstall -y'.format_map(locals())
+            uninstall_each = [
+                '{uninstall} {dist}'.format_map(locals()) for dist in remove_distributions]
+            remote(config, (
+                uninstall, remove_distributions, '||',
+                '(', '; '.join(uninstall_each), ')',
+            ), abort_on_failure=False)
 
         remote(config, (
+            'umask 007 &&',
             '{remote.build.pip} install',
             '--no-index',
             '--find-links {remote.pip.wheel_dir}',
@@ -360,35 +727,61 @@ class Deployer:
         redundant, but it's left in for clarity.
 
         """
+        self.wait_for_background_tasks()
         printer.header('Linking new version and restarting...')
         config = self.config
         link(config, config.version)
-        restart(config)
+        restart(config, get=False)
+        # The site is requested in the background to load the app while
+        # any remaining steps run.
+        self.run_in_background(warm_up, config)
 
     def set_permissions(self):
         """Explicitly, recursively chmod remote build directories.
 
+        Files created by a deployment are given the right permissions
+        when they're created (via umask, rsync's --chmod option, etc),
+        so this is only needed to fix up builds and log files created
+        some other way. It's off by default.
+
         Permissions are updated after restarting because this could take
         a while. The chmod command is run in the background because we don't
         want to sit around waiting, and we assume it will succeed.
 
+        Only files and directories that don't already have the expected
+        permissions are passed to chmod, which makes this mostly a no-op
+        for directories that were already fixed up by a previous deploy.
+
         """
         printer.header('Setting permissions in background...')
 
-        def chmod(mode, where, options='-R', host='hrimfaxi.oit.pdx.edu'):
-            args = (options, mode, where)
+        def chmod(mode, where, wrong, host='hrimfaxi.oit.pdx.edu'):
+            # The pipeline is quoted for the sh run via sudo, and the
+            # whole remote command is quoted again since ssh passes it
+            # through the remote user's shell.
+            script = ' '.join((
+                'nohup find', where, wrong, '-print0 2>/dev/null |',
+                'nohup xargs -0 -r -P 4 chmod', mode, '>/dev/null 2>&1 &',
+            ))
+            remote_command = 'sudo -u {service.user} sh -c ' + shlex.quote(script)
             local(self.config, (
-                'ssh -f', host,
-                'sudo -u {service.user} sh -c "nohup chmod', args, '>/dev/null 2>&1 &"',
+                'ssh -f', ssh_options(self.config), host, shlex.quote(remote_command),
             ))
 
-        chmod('ug=rwX,o-rwx', '{remote.build.dir} {remote.path.log_dir} {remote.path.static}')
+        # Select only the entries ug=rwX,o-rwx would actually change: user
+        # or group can't read/write, others have any access, or it's a
+        # directory or executable file that user or group can't execute.
+        chmod('ug=rwX,o-rwx', '{remote.build.dir} {remote.path.log_dir} {remote.path.static}', (
+            '\\( ! -perm -660 -o -perm /007 -o '
+            '\\( \\( -type d -o -perm /111 \\) ! -perm -110 \\) \\)'
+        ))
 
 
 @command(default_env='stage', timed=True)
 def deploy(config, version=None, deployer_class=None, provision=True, overwrite=False, push=True,
            static=True, build_static=True, deps=(), remove_distributions=(), wheels=True,
-           install=True, push_config=True, migrate=False, make_active=True, set_permissions=True):
+           install=True, push_config=True, migrate=False, make_active=True, set_permissions=False,
+           clean_build=True, wheel_jobs=1):
     """Deploy a new version.
 
     All of the command options are used to construct a :class:`Deployer`,
@@ -397,6 +790,18 @@ def deploy(config, version=None, deployer_class=None, provision=True, overwrite=
     class must accept a ``config`` arg plus arbitrary keyword args (which
     it is free to ignore).
 
+    Pass ``--no-clean-build`` to keep the static files from the previous
+    local build of the same version so only changed static files are
+    collected.
+
+    Pass ``--wheel-jobs N`` to build wheels for the project's
+    requirements using up to N concurrent pip processes on the remote
+    host. This can speed things up considerably when several
+    requirements have C extensions that need to be compiled.
+
+    Pass ``--set-permissions`` to recursively fix up permissions in the
+    remote build, log, and static directories after deploying.
+
     """
     if deployer_class is None:
         deployer_class = deploy.deployer_class
@@ -417,6 +822,8 @@ def deploy(config, version=None, deployer_class=None, provision=True, overwrite=
         migrate=migrate,
         make_active=make_active,
         set_permissions=set_permissions,
+        clean_build=clean_build,
+        wheel_jobs=wheel_jobs,
     )
     try:
         deployer.run()
@@ -428,6 +835,9 @@ deploy.deployer_class = Deployer
 deploy.set_deployer_class = lambda class_: setattr(deploy, 'deployer_class', class_)
 
 
+_builds_separator = '---'
+
+
 def get_active_version(config, **kwargs):
     kwargs.setdefault('abort_on_failure', False)
     kwargs.setdefault('hide', 'stdout')
@@ -460,19 +870,33 @@ def builds(config, active=False, rm=(), yes=False):
 
     if rm:
         rm = [rm] if isinstance(rm, str) else rm
-        build_dirs = ['{build_root}/{v}'.format(build_root=build_root, v=v) for v in rm]
-        cmd = ' && '.join('test -d {d}'.format(d=d) for d in build_dirs)
-        result = remote(config, cmd, echo=False, abort_on_failure=False)
-        if result.failed:
-            printer.error('Build directory not found')
-        else:
-            cmd = 'rm -r {dirs}'.format(dirs=' '.join(build_dirs))
-            printer.header('The following builds will be removed:')
-            for d in build_dirs:
-                print(d)
-            prompt = 'Remove builds?'
-            if yes or confirm(config, prompt, color='error', yes_values=('yes',)):
-                remote(config, cmd)
+        build_dirs = [shlex.quote(posixpath.join(build_root, v)) for v in rm]
+        check_build_dirs = (
+            'for d in', build_dirs, '; do',
+            'if ! test -d "$d"; then echo "Build directory not found: $d"; exit 1; fi;',
+            'done',
+        )
+        if not yes:
+            # Make sure all of the builds exist before asking whether to
+            # remove them.
+            result = remote(
+                config, check_build_dirs, echo=False, hide='stdout', abort_on_failure=False)
+            if result.failed:
+                printer.error(result.stdout.strip() or 'Build directory not found')
+                return
+        printer.header('The following builds will be removed:')
+        for d in build_dirs:
+            print(d)
+        prompt = 'Remove builds?'
+        if yes or confirm(config, prompt, color='error', yes_values=('yes',)):
+            # The build directories are checked again in the same remote
+            # call that removes them. Nothing is removed if any of them is
+            # missing.
+            result = remote(config, (
+                check_build_dirs, '&& rm -r --', build_dirs,
+            ), echo=False, hide='stdout', abort_on_failure=False)
+            if result.failed:
+                printer.error(result.stdout.strip() or 'Build directory not found')
     else:
         if active:
             header = 'Active version for {env} (in {build_root}):'
@@ -483,48 +907,71 @@ def builds(config, active=False, rm=(), yes=False):
 
         data = []
 
-        _, active_version = get_active_version(config)
-
-        # Get path and timestamp of last modification for each build
-        # directory.
+        # Get the active build path and the path and timestamp of last
+        # modification for each build directory in a single remote call.
         #
-        # Example stat entry:
+        # Example output:
         #
-        #    "/vol/www/xyz/builds/stage/1.0.0/ 1453426316"
-        stat_path = '{build_root}/*/'.format_map(locals())
-        result = remote(config, ('stat -c "%n %Y"', stat_path), echo=False, hide='stdout')
-
-        if result and result.stdout_lines:
-            # Parse each stat entry into path, base name, timestamp.
-            for line in result.stdout_lines:
-                path, timestamp = line.split(' ', 1)
-                path = path.rstrip(posixpath.sep)
-                base_name = posixpath.basename(path)
-                timestamp = datetime.fromtimestamp(int(timestamp))
-                data.append((path, base_name, timestamp))
-
-            # Sort entries by timestamp.
-            data = sorted(data, key=lambda item: item[2], reverse=True)
-
-            # Print the builds in timestamp order (newest first).
-            longest = max(len(d[1]) for d in data)
-            for d in data:
-                path, version, timestamp = d
-                is_active = path == active_version
-                out = ['{0:<{longest}} {1}'.format(version, timestamp, longest=longest)]
-                if is_active and not active:
-                    out.append('[active]')
-                out = ' '.join(out)
-                if is_active:
-                    printer.success(out)
-                elif not active:
-                    print(out)
+        #    /vol/www/xyz/builds/stage/1.0.0
+        #    ---
+        #    /vol/www/xyz/builds/stage/1.0.0 1453426316.4411234560
+        #    /vol/www/xyz/builds/stage/1.0.1 1453512716.0930412340
+        #
+        # When only the active build is wanted, only its directory is
+        # passed to find rather than having it stat every build.
+        if active:
+            find_args = ('"$(readlink {remote.path.env})"', '-maxdepth 0')
+        else:
+            find_args = (build_root, '-mindepth 1 -maxdepth 1')
+        result = remote(config, (
+            'readlink {remote.path.env};',
+            'echo', _builds_separator, ';',
+            'find', find_args, '-type d -printf "%p %T@\\n"',
+        ), echo=False, hide='stdout', abort_on_failure=False)
+
+        lines = result.stdout_lines if result.stdout else []
+        if _builds_separator in lines:
+            separator_index = lines.index(_builds_separator)
+            active_lines, lines = lines[:separator_index], lines[separator_index + 1:]
+            active_version = active_lines[0] if active_lines else None
+            cache_readlink(config, '{remote.path.env}', active_version)
+        else:
+            active_version = None
+
+        if result and lines:
+            # Parse each entry into path, base name, timestamp.
+            basename = posixpath.basename
+            fromtimestamp = datetime.fromtimestamp
+            entries = (line.rsplit(' ', 1) for line in lines)
+            entries = ((path.rstrip('/'), timestamp) for (path, timestamp) in entries)
+            data.extend(
+                (path, basename(path), fromtimestamp(int(float(timestamp))))
+                for (path, timestamp) in entries)
+
+            # Sort entries by timestamp in place.
+            data.sort(key=itemgetter(2), reverse=True)
+            _print_builds(data, active_version, active_only=active)
         else:
             printer.warning('No {env} builds found in {build_root}'.format_map(locals()))
 
         return active_version, data
 
 
+def _print_builds(data, active_path, active_only=False):
+    """Print builds (path, version, timestamp) in the order given."""
+    longest = max(len(d[1]) for d in data)
+    for path, version, timestamp in data:
+        is_active = path == active_path
+        out = ['{0:<{longest}} {1}'.format(version, timestamp, longest=longest)]
+        if is_active and not active_only:
+            out.append('[active]')
+        out = ' '.join(out)
+        if is_active:
+            printer.success(out)
+        elif not active_only:
+            print(out)
+
+
 @command(
     env=True,
     config={
@@ -537,8 +984,9 @@ def clean_builds(config, keep=3):
 
     build_root = config.remote.build.root
 
-    active_version, versions = builds(config)
-    versions = [item[1] for item in versions]
+    active_path, data = builds(config)
+    versions = [item[1] for item in data]
+    active_version = posixpath.basename(active_path.rstrip('/')) if active_path else None
 
     # Move active version to beginning to ensure it's not removed
     if active_version in versions:
@@ -560,7 +1008,9 @@ def clean_builds(config, keep=3):
             printer.danger('Removing {0}...'.format(versions_to_remove_str))
             rm_paths = [posixpath.join(build_root, v) for v in versions_to_remove]
             remote(config, ('rm -r', rm_paths), echo=True)
-            builds(config)
+            # Show the remaining builds without listing them again.
+            printer.header('\nRemaining builds for {env}:'.format_map(config))
+            _print_builds([d for d in data if d[1] in versions_to_keep], active_path)
     else:
         printer.warning('\nNo versions to remove')
 
@@ -582,30 +1032,78 @@ def link(config, version, staticfiles_manifest=True, old_style=None):
         cmd.append(
             'ln -sfn {remote.build.static}/staticfiles.json {remote.path.static}/staticfiles.json')
 
-    remote(config, ' && '.join(cmd))
-
     # XXX: This supports old-style deployments where the media and
     #      static directories are in the source directory.
     if old_style:
-        remote(config, (
-            'ln -sfn {remote.path.media} {remote.build.dir}/media &&',
-            'ln -sfn {remote.path.static} {remote.build.dir}/static',
-        ))
+        cmd.append('ln -sfn {remote.path.media} {remote.build.dir}/media')
+        cmd.append('ln -sfn {remote.path.static} {remote.build.dir}/static')
+
+    remote(config, ' && '.join(cmd))
+    forget_readlink(config, '{remote.path.env}')
+
+
+_push_static_tar_threshold = 200
 
 
 @command
-def push_static(config, build=True, dry_run=False, delete=False, echo=False, hide=None):
+def push_static(config, build=True, dry_run=False, delete=False, compress=False, echo=False,
+                hide=None):
+    """Push static files to the shared static directory.
+
+    Static files are mostly either already compressed (images, fonts)
+    or small, so when they're rsync'ed, they aren't compressed in
+    transit by default. Pass ``--compress`` to compress them anyway
+    (e.g., over a slow connection).
+
+    """
     static_root = config.path.build.static_root
     if build:
         build_static(config, static_root=static_root)
     if not static_root.endswith(os.sep):
         static_root += os.sep
-    rsync(
-        config, static_root, config.remote.path.static, dry_run=dry_run, delete=delete, echo=echo,
-        hide=hide, excludes=('staticfiles.json',))
+    # The static tree is walked once up front and the resulting file list
+    # is handed to tar or rsync so neither has to walk it again. This is
+    # skipped when deleting since rsync only deletes files from
+    # directories it transfers in full, which it won't do when given an
+    # explicit file list.
+    static_files = None if delete else list_files(static_root)
+    # When there are a lot of static files, copying them as a single tar
+    # stream is much faster than rsync'ing them one by one. rsync is
+    # still used for dry runs and to delete stale files since tar can't
+    # do either.
+    # The manifest is uploaded while the static files are being copied
+    # but isn't linked into place until they've all been copied.
     manifest = os.path.join(static_root, 'staticfiles.json')
     if os.path.isfile(manifest):
-        copy_file(config, manifest, config.remote.build.static)
+        executor = ThreadPoolExecutor(max_workers=1)
+        manifest_copied = executor.submit(
+            copy_file, config, manifest, config.remote.build.static)
+        executor.shutdown(wait=False)
+    else:
+        manifest_copied = None
+    use_tar = (
+        static_files is not None and
+        not dry_run and
+        len(static_files) > _push_static_tar_threshold)
+    if use_tar:
+        copy_tree(
+            config, static_root, config.remote.path.static, paths=static_files,
+            excludes=('staticfiles.json',), quiet=not echo)
+    elif static_files is not None:
+        with tempfile.NamedTemporaryFile('w', prefix='static-files-', suffix='.txt') as files_fp:
+            files_fp.writelines('{path}\n'.format(path=path) for path in static_files)
+            files_fp.flush()
+            rsync(
+                config, static_root, config.remote.path.static, dry_run=dry_run, echo=echo,
+                hide=hide, excludes=('staticfiles.json',), whole_file=True, compress=compress,
+                files_from=files_fp.name)
+    else:
+        rsync(
+            config, static_root, config.remote.path.static, dry_run=dry_run, delete=delete,
+            echo=echo, hide=hide, excludes=('staticfiles.json',), whole_file=True,
+            compress=compress)
+    if manifest_copied is not None:
+        manifest_copied.result()
         remote(config, (
             'ln -sf',
             '{remote.build.static}/staticfiles.json',
@@ -613,33 +1111,68 @@ def push_static(config, build=True, dry_run=False, delete=False, echo=False, hid
         ))
 
 
+_restart_get_read_size = 4096
+_restart_get_timeout = 30
+
+
 @command
-def restart(config, get=True, scheme='https', path='/', show=False):
-    settings = django.get_settings(config)
+def restart(config, get=True, scheme='https', path='/', show=False, requests=1):
+    """Restart the app and get a page from the site.
+
+    Pass ``--requests N`` to make N concurrent requests for the page,
+    e.g. to load the app in each of N mod_wsgi daemon processes.
+
+    """
     remote(config, '$(readlink {remote.path.env})/restart')
     if get:
-        host = getattr(settings, 'DOMAIN_NAME', None)
-        if host is None:
-            host = settings.ALLOWED_HOSTS[0]
-            host = host.lstrip('.')
-        else:
-            printer.warning(
-                'The DOMAIN_NAME setting is deprecated; '
-                'set the first entry in ALLOWED_HOSTS to the canonical host instead')
-        if not path.startswith('/'):
-            path = '/{path}'.format(path=path)
-        url = '{scheme}://{host}{path}'.format_map(locals())
-        printer.info('Getting {url}...'.format_map(locals()))
-        urlopen_args = {}
-        if sys.version_info[:2] > (3, 3):
-            urlopen_args['context'] = ssl.SSLContext()
+        warm_up(config, scheme, path, show, requests)
+
+
+def warm_up(config, scheme='https', path='/', show=False, requests=1):
+    """Get a page from the site so the app is loaded after a restart.
+
+    When ``requests`` is greater than 1, the page is requested that many
+    times concurrently.
+
+    """
+    settings = django.get_settings(config)
+    host = getattr(settings, 'DOMAIN_NAME', None)
+    if host is None:
+        host = settings.ALLOWED_HOSTS[0]
+        host = host.lstrip('.')
+    else:
+        printer.warning(
+            'The DOMAIN_NAME setting is deprecated; '
+            'set the first entry in ALLOWED_HOSTS to the canonical host instead')
+    if not path.startswith('/'):
+        path = '/{path}'.format(path=path)
+    url = '{scheme}://{host}{path}'.format_map(locals())
+    printer.info('Getting {url}...'.format_map(locals()))
+    urlopen_args = {'timeout': _restart_get_timeout}
+    if sys.version_info[:2] > (3, 3):
+        urlopen_args['context'] = ssl.SSLContext()
+
+    def get(read_all=False):
         try:
             with urlopen(url, **urlopen_args) as url_fp:
-                data = url_fp.read()
+                # Getting the response is enough to know the app has
+                # started; only read the whole body if it will be shown.
+                data = url_fp.read() if read_all else url_fp.read(_restart_get_read_size)
+                return data, url_fp.status
         except (HTTPError, URLError) as exc:
-            abort(1, 'Failed to retrieve {url}: {exc}'.format_map(locals()))
-        if show:
-            print(data.decode('utf-8'))
+            abort(1, 'Failed to retrieve {url}: {exc}'.format(url=url, exc=exc))
+
+    if requests > 1:
+        with ThreadPoolExecutor(max_workers=requests) as executor:
+            results = [executor.submit(get, show and i == 0) for i in range(requests)]
+            data, status = results[0].result()
+            for result in results[1:]:
+                result.result()
+    else:
+        data, status = get(show)
+    printer.info('Got {url} ({status})'.format_map(locals()))
+    if show:
+        print(data.decode('utf-8'))
 
 
 # Utilities
@@ -650,32 +1183,21 @@ def copy_file_local(config, path, destination_path, template=False, template_typ
     destination_path = abs_path(destination_path, format_kwargs=config)
 
     if template:
-        with open(path) as in_fp:
-            contents = in_fp.read()
-
-        if template_type in (None, 'format'):
-            contents = contents.format_map(config)
-        elif template_type == 'string':
-            template = string.Template(contents)
-            contents = template.substitute(config)
-        else:
-            raise ValueError('Unrecognized template type: %s' % template_type)
-
-        prefix = '%s-' % config.package
-        suffix = '-%s' % os.path.basename(path)
-        temp_fd, temp_path = tempfile.mkstemp(prefix=prefix, suffix=suffix, text=True)
-
-        with os.fdopen(temp_fd, 'w') as temp_file:
-            temp_file.write(contents)
+        contents = render_template(config, path, template_type)
 
         if os.path.isdir(destination_path):
             base_name = os.path.basename(path)
             name, ext = os.path.splitext(base_name)
             if ext == '.template':
-                destination_path = os.path.join(destination_path, name)
+                base_name = name
+            destination_path = os.path.join(destination_path, base_name)
+
+        # The rendered template is written directly to its destination
+        # rather than to a temporary file that's then copied.
+        with open(destination_path, 'w') as out_fp:
+            out_fp.write(contents)
 
-        copy_path = shutil.copy(temp_path, destination_path)
-        os.remove(temp_path)
+        copy_path = destination_path
     else:
         copy_path = shutil.copy(path, destination_path)
 
@@ -685,9 +1207,137 @@ def copy_file_local(config, path, destination_path, template=False, template_typ
     return copy_path
 
 
-def make_dist(config, path, dist_dir=None):
+_config_section_re = re.compile(r'^\[(?P<name>[^\]]+)\]\s*$')
+_config_option_re = re.compile(r'^(?P<key>[^\s;#=:][^=:]*?)\s*[=:]')
+
+
+def set_default_config_values(contents, values):
+    """Set ``values`` in the [DEFAULT] section of config file ``contents``.
+
+    This works on the raw text of the config file rather than parsing
+    and re-serializing it. Any existing definitions of the specified
+    options in the [DEFAULT] section (including any continuation lines)
+    are removed and the new values are inserted at the top of the
+    section. If there's no [DEFAULT] section, one is added at the top.
+    Everything else, including comments, is left as is.
+
+    Returns the updated contents.
+
+    """
+    lines = contents.splitlines(True)
+    new_lines = ['{k} = {v}\n'.format(k=k, v=v) for (k, v) in values.items()]
+
+    for start, line in enumerate(lines):
+        match = _config_section_re.match(line)
+        if match and match.group('name') == 'DEFAULT':
+            break
+    else:
+        return ''.join(['[DEFAULT]\n'] + new_lines + ['\n'] + lines)
+
+    section_lines = []
+    removing = False
+    end = len(lines)
+    for i in range(start + 1, len(lines)):
+        line = lines[i]
+        if _config_section_re.match(line):
+            end = i
+            break
+        if removing and line[:1].isspace() and line.strip():
+            continue
+        match = _config_option_re.match(line)
+        removing = bool(match) and match.group('key') in values
+        if not removing:
+            section_lines.append(line)
+
+    return ''.join(lines[:start + 1] + new_lines + section_lines + lines[end:])
+
+
+_pinned_requirement_re = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*==\s*([^\s;#]+)')
+
+
+_requirement_name_re = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+
+def _normalize_dist_name(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def _is_sdist_of(file_name, normalized_name):
+    """Is ``file_name`` a source distribution of the named project?"""
+    prefix = normalized_name + '_'
+    file_name = _normalize_dist_name(file_name)
+    return file_name.startswith(prefix) and file_name[len(prefix):len(prefix) + 1].isdigit()
+
+
+def make_dist(config, path, dist_dir=None, cache_dir=None):
+    """Make a source distribution for the project in ``path``.
+
+    If ``cache_dir`` is passed and ``path`` is in a git work tree, the
+    sdist is cached under ``cache_dir`` (see :func:`_get_dist_cache_key`).
+    Subsequent calls for the same source will copy the cached sdist into
+    ``dist_dir`` instead of building it again.
+
+    """
+    cache_key = _get_dist_cache_key(path) if cache_dir else None
+    if cache_key:
+        build_dir = os.path.join(cache_dir, cache_key)
+        if os.path.isdir(build_dir) and os.listdir(build_dir):
+            printer.info('Using cached sdist for {path} ({cache_key})'.format_map(locals()))
+            os.makedirs(dist_dir, exist_ok=True)
+            for name in os.listdir(build_dir):
+                shutil.copy2(os.path.join(build_dir, name), dist_dir)
+            return
+        # Build into a temporary directory so an interrupted build isn't
+        # mistaken for a cached sdist later.
+        build_dir_tmp = '{build_dir}.part'.format_map(locals())
+        shutil.rmtree(build_dir_tmp, ignore_errors=True)
+        os.makedirs(build_dir_tmp)
+    else:
+        build_dir_tmp = dist_dir
+
     cmd = [sys.executable, 'setup.py sdist']
-    if dist_dir:
-        cmd.append('-d {dist_dir}'.format_map(locals()))
+    if build_dir_tmp:
+        cmd.append('-d {build_dir_tmp}'.format_map(locals()))
     printer.info('Making sdist in {path}; saving to {dist_dir}...'.format_map(locals()))
     local(config, cmd, cd=path, hide='all')
+
+    if cache_key:
+        os.rename(build_dir_tmp, build_dir)
+        os.makedirs(dist_dir, exist_ok=True)
+        for name in os.listdir(build_dir):
+            shutil.copy2(os.path.join(build_dir, name), dist_dir)
+
+
+def _get_dist_cache_key(path):
+    """Get a key identifying the source in the git work tree in ``path``.
+
+    For a clean work tree, this is the commit it's at. When there are
+    uncommitted changes, it's a hash of the commit plus the names and
+    contents of all files that aren't ignored (tracked or not), so an
+    sdist is only rebuilt when something that could be in it changes.
+
+    Returns ``None`` if ``path`` isn't in a git work tree.
+
+    """
+    git_args = dict(cwd=path, stderr=subprocess.DEVNULL)
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], **git_args)
+        commit = commit.decode('ascii').strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain'], **git_args)
+        if not status.strip():
+            return commit
+        names = subprocess.check_output(
+            ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'], **git_args)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    cache_key = hashlib.sha256(commit.encode('ascii'))
+    for name in sorted(set(names.decode('utf-8').split('\0'))):
+        file_path = os.path.join(path, name)
+        if not name or not os.path.isfile(file_path):
+            continue
+        cache_key.update('{name}\0{size}\0'.format(
+            name=name, size=os.path.getsize(file_path)).encode('utf-8'))
+        with open(file_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                cache_key.update(chunk)
+    return '{commit}-{digest}'.format(commit=commit, digest=cache_key.hexdigest())
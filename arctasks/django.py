@@ -1,34 +1,71 @@
+import multiprocessing
 import os
+import shlex
 
 from runcommands import command
 from runcommands.commands import local
+from runcommands.config import Config
 from runcommands.util import Hide, abort, abs_path, printer
 
 
+_setup_done = False
+
+# Django's management module; this is set by setup() so Django isn't
+# imported until a command actually needs it.
+_management = None
+
+
 def setup(config):
+    """Set up Django.
+
+    Django is only set up once per process. Subsequent calls are no-ops
+    since the settings can't be changed after setup anyway (and setup
+    reconfigures logging each time it's called).
+
+    """
+    global _management, _setup_done
+    if _setup_done:
+        return
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', config.get('django_settings_module'))
     os.environ.setdefault('LOCAL_SETTINGS_FILE', config.get('local_settings_file'))
-    import django
+    try:
+        import django
+        import django.core.management
+    except ImportError:
+        abort(1, 'Django is not installed')
     django.setup()
+    _management = django.core.management
+    _setup_done = True
+
+
+_settings = None
 
 
 def get_settings(config):
-    setup(config)
-    import django.conf
-    return django.conf.settings
+    global _settings
+    if _settings is None:
+        setup(config)
+        import django.conf
+        _settings = django.conf.settings
+    return _settings
+
+
+# Opened on first use and kept open for the rest of the process.
+_devnull = None
 
 
 def call_command(config, *args, hide=None, **kwargs):
+    global _devnull
     setup(config)
-    import django.core.management
     try:
         if hide:
-            with open(os.devnull, 'w') as devnull:
-                stdout = devnull if Hide.hide_stdout(hide) else None
-                stderr = devnull if Hide.hide_stderr(hide) else None
-                django.core.management.call_command(*args, stdout=stdout, stderr=stderr, **kwargs)
+            if _devnull is None:
+                _devnull = open(os.devnull, 'w')
+            stdout = _devnull if Hide.hide_stdout(hide) else None
+            stderr = _devnull if Hide.hide_stderr(hide) else None
+            _management.call_command(*args, stdout=stdout, stderr=stderr, **kwargs)
         else:
-            django.core.management.call_command(*args, **kwargs)
+            _management.call_command(*args, **kwargs)
     except KeyboardInterrupt:
         abort(message='\nAborted Django management command')
 
@@ -36,61 +73,105 @@ def call_command(config, *args, hide=None, **kwargs):
 @command(default_env='dev')
 def manage(config, args, cd=None, sudo=False, run_as=None, echo=None, hide=None,
            abort_on_failure=True):
-    local(
-        config, ('{bin.python}', 'manage.py', args),
-        cd=cd, sudo=sudo, run_as=run_as, echo=echo, hide=hide, abort_on_failure=abort_on_failure)
+    """Run a Django management command.
+
+    The command is run in-process unless it needs to be run in another
+    directory or as another user, in which case ``manage.py`` is run in
+    a subprocess.
+
+    """
+    if cd or sudo or run_as:
+        return local(
+            config, ('{bin.python}', 'manage.py', args),
+            cd=cd, sudo=sudo, run_as=run_as, echo=echo, hide=hide,
+            abort_on_failure=abort_on_failure)
+    args = shlex.split(args) if isinstance(args, str) else list(args)
+    if echo:
+        printer.info('manage.py', *args)
+    setup(config)
+    try:
+        call_command(config, *args, hide=hide)
+    except _management.CommandError as exc:
+        if abort_on_failure:
+            abort(1, str(exc))
+        printer.error(exc)
 
 
 @command(default_env='dev')
 def makemigrations(config, app=None):
-    args = [app]
-    args = [a for a in args if a]
-    call_command(config, 'makemigrations', *args)
+    call_command(config, 'makemigrations', *filter(None, (app,)))
 
 
 @command(default_env='dev')
 def migrate(config, app=None, migration=None):
     if migration and not app:
         abort(1, 'You must specify an app to run a specific migration')
-    args = [app, migration]
-    args = [a for a in args if a]
-    call_command(config, 'migrate', *args)
+    call_command(config, 'migrate', *filter(None, (app, migration)))
 
 
 @command(default_env='test')
 def test(config, test_=(), failfast=False, keepdb=True, verbosity=1, with_coverage=False,
-         force_env=None):
+         force_env=None, parallel='auto'):
+    """Run tests.
+
+    By default, tests are run in parallel using one process per CPU
+    (via Django's --parallel option). Tests have to be isolated from
+    each other for this to work; pass ``--parallel 1`` to run them
+    serially. Tests are always run serially when measuring coverage
+    since coverage isn't collected from the test processes.
+
+    """
     debug = config._get_dotted('run.debug', None)
+    if with_coverage:
+        parallel = 1
+    elif parallel == 'auto':
+        parallel = multiprocessing.cpu_count()
+    else:
+        parallel = int(parallel)
     if force_env and force_env != config.env:
         # NOTE: We have to use a subprocess for this because calling
         # django.setup() again in the same process will have no effect.
+        # The other env's config is loaded here, so only Django's test
+        # runner needs to be started in the subprocess, not another
+        # runcommands process.
         printer.warning(
             'Forcing tests to run in {force_env} env instead of {config.env}'
             .format_map(locals()))
 
-        # Don't propagate these to the subprocess
-        django_settings_module = os.environ.pop('DJANGO_SETTINGS_MODULE', None)
-        local_settings_file = os.environ.pop('LOCAL_SETTINGS_FILE', None)
+        run_config = config.run.copy()
+        run_config.env = force_env
+        force_config = Config(run=run_config)
+
+        # These override any values inherited from this process.
+        environ = (
+            ('DJANGO_SETTINGS_MODULE', force_config.django_settings_module),
+            ('LOCAL_SETTINGS_FILE', force_config.local_settings_file),
+        )
 
         local(config, (
-            'runcommand', '--env', force_env, 'test',
-            [('--test', t) for t in test_],
+            ['{name}={value}'.format(name=name, value=shlex.quote(value))
+             for (name, value) in environ],
+            '{bin.python}',
+            ('-m coverage run --source', config.package) if with_coverage else '',
+            '-m django test',
+            test_,
             '--failfast' if failfast else '',
             '--keepdb' if keepdb else '',
             '--verbosity', str(verbosity),
-            '--with-coverage' if with_coverage else '',
+            ('--parallel', str(parallel)) if parallel > 1 else '',
         ), echo=debug)
 
-        if django_settings_module is not None:
-            os.environ['DJANGO_SETTINGS_MODULE'] = django_settings_module
-        if local_settings_file is not None:
-            os.environ['LOCAL_SETTINGS_FILE'] = local_settings_file
+        if with_coverage:
+            local(config, '{bin.python} -m coverage report', echo=debug)
     else:
         if with_coverage:
             from coverage import coverage
             cov = coverage(source=[config.package])
             cov.start()
-        call_command(config, 'test', *test_, failfast=failfast, keepdb=keepdb, verbosity=verbosity)
+        kwargs = dict(failfast=failfast, keepdb=keepdb, verbosity=verbosity)
+        if parallel > 1:
+            kwargs['parallel'] = parallel
+        call_command(config, 'test', *test_, **kwargs)
         if with_coverage:
             cov.stop()
             cov.report()
@@ -126,11 +207,11 @@ def mod_wsgi_express(config, host=_runserver_host, port=_runserver_port, process
     default_media_alias = (media_url, settings.MEDIA_ROOT)
     default_static_alias = (static_url, settings.STATIC_ROOT)
 
-    has_alias = lambda check_url: any((alias_url == check_url) for (alias_url, _) in aliases)
+    alias_urls = {alias_url for (alias_url, _) in aliases}
 
-    if not has_alias(media_url):
+    if media_url not in alias_urls:
         aliases.append(default_media_alias)
-    if not has_alias(static_url):
+    if static_url not in alias_urls:
         aliases.append(default_static_alias)
 
     aliases = [(path, abs_path(fs_path)) for (path, fs_path) in aliases]
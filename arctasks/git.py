@@ -1,23 +1,41 @@
+import os
+import re
 import subprocess
 
 from runcommands.util import abort, confirm, printer
 
 
+# Directories already checked to be in a git work tree, so the check
+# only runs once per directory instead of before every git command.
+_work_tree_dirs = set()
+
+
 def run(args, return_output=False, **subprocess_args):
     # Make sure we're in a git work tree.
     # TODO: Be even more strict and require $PWD/.git?
-    try:
-        subprocess.check_call(
-            ['git', 'rev-parse', '--is-inside-work-tree'], stdout=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        abort(1, 'Cannot run git commands outside of a git repository.')
+    cwd = os.path.abspath(subprocess_args.get('cwd') or os.getcwd())
+    if cwd not in _work_tree_dirs:
+        try:
+            subprocess.check_call(
+                ['git', 'rev-parse', '--is-inside-work-tree'], cwd=cwd,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            abort(1, 'Cannot run git commands outside of a git repository.')
+        _work_tree_dirs.add(cwd)
 
     if isinstance(args, str):
         args = args.split()
     git_args = ['git']
     git_args.extend(args)
 
+    # None of the git commands run here read from stdin, so make sure git
+    # can't block waiting for input from it.
+    subprocess_args.setdefault('stdin', subprocess.DEVNULL)
+
     if return_output:
+        # Commands whose output is captured shouldn't prompt for anything
+        # either (e.g., for credentials).
+        subprocess_args.setdefault('env', dict(os.environ, GIT_TERMINAL_PROMPT='0'))
         output = subprocess.check_output(git_args, **subprocess_args)
         output = output.decode('utf-8').strip()
         return output
@@ -39,11 +57,16 @@ def commit_files(files, message=None, add=True):
     f = locals()
     if add:
         run(['add'] + files)
-    output = run(['diff', '--cached', '--color=always'], return_output=True)
-    output = output.strip()
-    if not output:
+    # diff --quiet exits with 1 when there are staged changes. The diff
+    # itself is written by git straight to stdout.
+    try:
+        run(['diff', '--cached', '--quiet'])
+    except subprocess.CalledProcessError as exc:
+        if exc.returncode != 1:
+            raise
+    else:
         abort(1, 'Nothing to commit')
-    print(output)
+    run(['--no-pager', 'diff', '--cached', '--color=always'])
     if not confirm({}, 'Commit this?'):
         abort(message='Commit aborted')
     prompt = 'Commit message '
@@ -75,6 +98,9 @@ def tag(tag_name, commit, annotate=True, message=None):
     run(args)
 
 
+_describe_re = re.compile(r'^(?P<tag>.+)-(?P<distance>\d+)-g(?P<sha1>[0-9a-f]+)$')
+
+
 def version(short=True):
     """Get tag associated with HEAD; fall back to SHA1.
 
@@ -91,9 +117,19 @@ def version(short=True):
             not always)
 
     """
-    try:
-        value = run(['describe', '--exact-match'], return_output=True, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        printer.warning('HEAD is not tagged; falling back to SHA1')
-        value = run(['rev-parse', '--short' if short else '', 'HEAD'], return_output=True)
+    # This gets both the tag and the SHA1 with a single git command. With
+    # --long, the output is always {tag}-{distance}-g{sha1} (or just the
+    # SHA1 when there are no tags), so HEAD is tagged when the distance
+    # from the nearest tag is 0.
+    args = ['describe', '--always', '--long']
+    if not short:
+        args.append('--abbrev=40')
+    value = run(args, return_output=True)
+    match = _describe_re.match(value)
+    if match is not None:
+        tag_name, distance, sha1 = match.groups()
+        if distance == '0':
+            return tag_name
+        value = sha1
+    printer.warning('HEAD is not tagged; falling back to SHA1')
     return value
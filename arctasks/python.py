@@ -1,5 +1,4 @@
-from packaging.version import parse
-from pkg_resources import find_distributions, get_distribution
+import glob
 from subprocess import check_call, CalledProcessError, DEVNULL
 
 from runcommands import command
@@ -32,36 +31,98 @@ def show_upgraded_packages(config):
     version outside its specified range.
 
     """
+    # This is imported here because it's only needed by this command.
+    from packaging.version import parse
+
     setup_cmd = ['python', 'setup.py', 'egg_info']
     try:
         check_call(setup_cmd, stdout=DEVNULL)
     except CalledProcessError:
         abort(1, 'Could not run `%s`' % ' '.join(setup_cmd))
 
-    dist = next(find_distributions('.', True), None)
-    if dist is None:
+    requirements = _get_local_requirements()
+    if requirements is None:
         abort(1, 'Could not find a Python distribution in current directory')
 
-    requirements = dist.requires()
-
     for req in requirements:
-        if not req.specs:
+        if not req.specifier:
             continue
 
-        specs = [(op, parse(v)) for (op, v) in req.specs]
-        specified_min_op, specified_min_version = min(specs, key=lambda item: item[1])
-        specified_max_op, specified_max_version = max(specs, key=lambda item: item[1])
-
-        dep = get_distribution(req.name)
-        installed_version = parse(dep.version)
+        # Find the lowest and highest specified versions in one pass.
+        specs = iter(req.specifier)
+        spec = next(specs)
+        specified_min_op = specified_max_op = spec.operator
+        specified_min_version = specified_max_version = parse(spec.version)
+        for spec in specs:
+            version = parse(spec.version)
+            if version < specified_min_version:
+                specified_min_op, specified_min_version = spec.operator, version
+            elif version > specified_max_version:
+                specified_max_op, specified_max_version = spec.operator, version
+
+        installed_version = _get_installed_version(req.name)
+        if installed_version is None:
+            printer.warning('{req.name} is not installed'.format_map(locals()))
+            continue
+        installed_version = parse(installed_version)
 
         if specified_min_version < installed_version:
-            print(dep.project_name, specified_min_version, '=>', installed_version)
+            print(req.name, specified_min_version, '=>', installed_version)
 
-        if not req.specifier.contains(str(installed_version)):
+        if not req.specifier.contains(installed_version):
             printer.warning(
-                '{dep.project_name} {installed_version} '
+                '{req.name} {installed_version} '
                 'is not in range specified in requirements: '
                 '{specified_min_op}{specified_min_version},'
                 '{specified_max_op}{specified_max_version}'
                 .format_map(locals()))
+
+
+def _get_local_requirements():
+    """Get the requirements of the distribution in the current directory.
+
+    This reads the metadata written by ``setup.py egg_info``. Optional
+    requirements (extras) are skipped. Returns a list of requirements
+    (:class:`packaging.requirements.Requirement` objects) or ``None`` if
+    there's no distribution metadata in the current directory.
+
+    importlib.metadata is used when available since it's much faster
+    to import than pkg_resources (which imports all of setuptools).
+
+    """
+    from packaging.requirements import Requirement
+    try:
+        from importlib.metadata import PathDistribution
+    except ImportError:  # Python < 3.8
+        from pkg_resources import find_distributions
+        dist = next(find_distributions('.', True), None)
+        if dist is None:
+            return None
+        requirements = (Requirement(str(req)) for req in dist.requires())
+    else:
+        import pathlib  # Not available before Python 3.4
+        egg_info_dirs = sorted(glob.glob('*.egg-info'))
+        if not egg_info_dirs:
+            return None
+        dist = PathDistribution(pathlib.Path(egg_info_dirs[0]))
+        requirements = (Requirement(req) for req in (dist.requires or ()))
+    return [
+        req for req in requirements
+        if req.marker is None or req.marker.evaluate({'extra': ''})
+    ]
+
+
+def _get_installed_version(name):
+    """Get the installed version of ``name`` or ``None`` if not installed."""
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:  # Python < 3.8
+        from pkg_resources import DistributionNotFound, get_distribution
+        try:
+            return get_distribution(name).version
+        except DistributionNotFound:
+            return None
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
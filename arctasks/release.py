@@ -13,7 +13,10 @@ The main commands are:
 import datetime
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+from functools import lru_cache
 
 from runcommands import command
 from runcommands.util import abort, abs_path, confirm, printer
@@ -43,8 +46,41 @@ FALLBACK_CHANGELOG_HEADER_RE = (
     r' +- +'
     r'(?P<release_date>unreleased)'
 )
-SETUP_GLOBAL_VERSION_RE = r'VERSION += +(?P<quote>(\'|"))(?P<old_version>.+)(\1)'
-SETUP_VERSION_RE = r'version=(?P<quote>(\'|"))(?P<old_version>.+)(\1),'
+SETUP_GLOBAL_VERSION_RE = r'VERSION += +(?P<quote>(\'|"))(?P<old_version>.+)(?P=quote)'
+SETUP_VERSION_RE = r'version=(?P<quote>(\'|"))(?P<old_version>.+)(?P=quote),'
+
+
+@lru_cache(maxsize=64)
+def anchor_pattern(pattern, flags=0):
+    """Anchor ``pattern`` for :func:`find_and_update_line` and compile it.
+
+    The compiled pattern matches an entire line, capturing its leading
+    and trailing whitespace. Compiled patterns are cached, so each
+    pattern is only compiled once per process.
+
+    """
+    return re.compile(r''.join((
+        r'^'
+        r'(?P<leading_whitespace>\s*)',
+        pattern,
+        r'(?P<trailing_whitespace>\s*)',
+        r'$'
+    )), flags)
+
+
+def changelog_header_pattern(version):
+    """Get the compiled change log header pattern for ``version``.
+
+    The compiled pattern is cached by :func:`anchor_pattern`.
+
+    """
+    return anchor_pattern(CHANGELOG_HEADER_RE.format(version=re.escape(version)), re.I)
+
+
+# The patterns that don't depend on the version are compiled up front.
+FALLBACK_CHANGELOG_HEADER_PATTERN = anchor_pattern(FALLBACK_CHANGELOG_HEADER_RE, re.I)
+SETUP_GLOBAL_VERSION_PATTERN = anchor_pattern(SETUP_GLOBAL_VERSION_RE)
+SETUP_VERSION_PATTERN = anchor_pattern(SETUP_VERSION_RE)
 
 
 @command(default_env='dev')
@@ -149,29 +185,28 @@ def prepare_release(config, version, release_date=None, changelog=DEFAULT_CHANGE
     files_to_commit = [changelog, version_file]
 
     if freeze_requirements:
-        # Freeze requirements
-        requirements_file = os.devnull if dry_run else 'requirements-frozen.txt'
-        with open(requirements_file, 'w') as requirements_fp:
-            subprocess.check_call(
-                [config.bin.pip, 'freeze', '-f', config.remote.pip.find_links],
-                stdout=requirements_fp)
+        # Freeze requirements. pip's output is captured and adjusted in
+        # memory, then written once.
+        requirements = subprocess.check_output(
+            [config.bin.pip, 'freeze', '-f', config.remote.pip.find_links],
+            universal_newlines=True)
         # Adjust frozen requirements:
         #   - Ensure distribution spec is correct in frozen requirements
         #   - Specify ARCTasks w/o a version
-        with open('requirements-frozen.txt') as requirements_fp:
-            requirements = requirements_fp.readlines()
         skip_requirements = (distribution, 'psu.oit.arc.tasks')
-        skip_requirement = lambda r: any((d in r) for d in skip_requirements)
-        adjusted_requirements = [r for r in requirements if not skip_requirement(r)]
+        adjusted_requirements = [
+            r for r in requirements.splitlines(True)
+            if not any((d in r) for d in skip_requirements)
+        ]
         adjusted_requirements[1:1] = [
             '{distribution}=={version}\n'.format_map(f),
             'psu.oit.arc.tasks\n',
         ]
-        with open(requirements_file, 'w') as requirements_fp:
-            if dry_run:
-                printer.info('[DRY RUN] New requirements-frozen.txt content would be:')
-                print(''.join(adjusted_requirements))
-            else:
+        if dry_run:
+            printer.info('[DRY RUN] New requirements-frozen.txt content would be:')
+            print(''.join(adjusted_requirements))
+        else:
+            with open('requirements-frozen.txt', 'w') as requirements_fp:
                 requirements_fp.writelines(adjusted_requirements)
         files_to_commit.append('requirements-frozen.txt')
 
@@ -286,22 +321,32 @@ def resume_development(config, version=None, changelog=DEFAULT_CHANGELOG, dry_ru
     print_dry_run_header(dry_run)
     printer.header('Resuming development at {version}'.format_map(f))
 
-    # Add section for next version to change log
-    with open(changelog) as fp:
-        lines = fp.readlines()
-    with open((os.devnull if dry_run else changelog), 'w') as fp:
-        new_lines = [
-            '\n',
-            '## {version} - unreleased\n'.format_map(f),
-            '\n',
-            'In progress...\n',
-            '\n',
-        ]
-        lines[1:1] = new_lines
-        if dry_run:
-            printer.info('[DRY RUN] Added change log section for {version}'.format_map(f))
-        else:
-            fp.writelines(lines)
+    # Add section for next version to change log. The section is
+    # inserted after the first line and the rest of the change log is
+    # copied through as is.
+    new_lines = [
+        '\n',
+        '## {version} - unreleased\n'.format_map(f),
+        '\n',
+        'In progress...\n',
+        '\n',
+    ]
+    if dry_run:
+        printer.info('[DRY RUN] Added change log section for {version}'.format_map(f))
+    else:
+        out_fp = tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(changelog) or '.',
+            prefix='.{name}.'.format(name=os.path.basename(changelog)), delete=False)
+        try:
+            with open(changelog) as in_fp, out_fp:
+                out_fp.write(in_fp.readline())
+                out_fp.writelines(new_lines)
+                shutil.copyfileobj(in_fp, out_fp)
+            shutil.copymode(changelog, out_fp.name)
+            os.replace(out_fp.name, changelog)
+        finally:
+            if os.path.exists(out_fp.name):
+                os.remove(out_fp.name)
 
     if version == 'next':
         dev_version = ''
@@ -340,7 +385,7 @@ def print_dry_run_header(dry_run):
 
 
 def find_and_update_line(file_name, pattern, line_updater, flags=0, abort_when_not_found=True,
-                         not_found_message=None, dry_run=False, debug=False):
+                         not_found_message=None, must_contain=(), dry_run=False, debug=False):
     """Find line matching pattern and update it.
 
     Leading & trailing whitespace is ignored.
@@ -350,7 +395,9 @@ def find_and_update_line(file_name, pattern, line_updater, flags=0, abort_when_n
         pattern (str): Regular expression pattern to search for. The
             first line matching this pattern will be updated. Note that
             this should *not* be anchored nor should it include leading
-            and trailing whitespace.
+            and trailing whitespace. This can also be a pattern that was
+            already compiled by :func:`anchor_pattern` (in which case
+            ``flags`` is ignored).
         line_updater (function): Function that updates the matched line.
             This will be passed the match object and the original line.
         flags: Flags for :func:`re.search`. E.g.: ``re.I``.
@@ -358,6 +405,11 @@ def find_and_update_line(file_name, pattern, line_updater, flags=0, abort_when_n
             when no line matching ``pattern`` is found.
         not_found_message (str): An optional additional message to show
             when no line matching ``pattern`` is found.
+        must_contain (tuple): Strings at least one of which must be in
+            a line for it to possibly match ``pattern``. Lines that
+            don't contain any of them are skipped without running the
+            regular expression. This is case-insensitive when the
+            pattern is.
         dry_run: Show what would be done, but don't actually do it
         debug: Show extra info that might be helpful for debugging
 
@@ -365,40 +417,67 @@ def find_and_update_line(file_name, pattern, line_updater, flags=0, abort_when_n
         bool: Indicates whether a line was found and updated.
 
     """
-    pattern = r''.join((
-        r'^'
-        r'(?P<leading_whitespace>\s*)',
-        pattern,
-        r'(?P<trailing_whitespace>\s*)',
-        r'$'
-    ))
+    if isinstance(pattern, str):
+        pattern = anchor_pattern(pattern, flags)
+
+    ignore_case = bool(pattern.flags & re.I)
+    if ignore_case:
+        must_contain = tuple(text.lower() for text in must_contain)
 
     updated_line_template = '{leading_whitespace}{line}{trailing_whitespace}'
 
     f = locals()
 
     if debug:
-        printer.info('Searching for a line matching "{pattern}" in {file_name}...'.format_map(f))
-
-    with open(file_name) as fp:
-        lines = fp.readlines()
-
-    for i, line in enumerate(lines):
-        match = re.search(pattern, line, flags)
-        if match:
-            original_line = line
-            updated_line = line_updater(match, line)
-            updated_line = updated_line_template.format(line=updated_line, **match.groupdict())
-            lines[i] = updated_line
-            line_number = i + 1
-            if debug:
-                printer.error('-', original_line, sep='', end='')
-                printer.success('+', updated_line, sep='', end='')
-            break
+        printer.info(
+            'Searching for a line matching "{pattern.pattern}" in {file_name}...'.format_map(f))
+
+    # The file is copied line by line into a temporary file next to it
+    # (or nowhere for a dry run), with the first matching line updated.
+    # Once the line is found, the rest of the file is copied as is. The
+    # temporary file then replaces the original file.
+    if dry_run:
+        out_fp = open(os.devnull, 'w')
     else:
+        out_fp = tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(file_name) or '.',
+            prefix='.{name}.'.format(name=os.path.basename(file_name)), delete=False)
+
+    found = False
+    try:
+        with open(file_name) as in_fp, out_fp:
+            for line_number, line in enumerate(in_fp, 1):
+                if must_contain:
+                    text = line.lower() if ignore_case else line
+                    if not any((t in text) for t in must_contain):
+                        out_fp.write(line)
+                        continue
+                match = pattern.search(line)
+                if match:
+                    found = True
+                    original_line = line
+                    updated_line = line_updater(match, line)
+                    updated_line = updated_line_template.format(
+                        line=updated_line, **match.groupdict())
+                    out_fp.write(updated_line)
+                    shutil.copyfileobj(in_fp, out_fp)
+                    if debug:
+                        printer.error('-', original_line, sep='', end='')
+                        printer.success('+', updated_line, sep='', end='')
+                    break
+                out_fp.write(line)
+        if found and not dry_run:
+            shutil.copymode(file_name, out_fp.name)
+            os.replace(out_fp.name, file_name)
+    finally:
+        if not dry_run and os.path.exists(out_fp.name):
+            os.remove(out_fp.name)
+
+    if not found:
         # No line matching pattern was found
         if debug:
-            printer.error('No line matching "{pattern}" found in {file_name}'.format_map(f))
+            printer.error(
+                'No line matching "{pattern.pattern}" found in {file_name}'.format_map(f))
         if abort_when_not_found:
             abort(1, not_found_message)
         elif not_found_message:
@@ -407,16 +486,15 @@ def find_and_update_line(file_name, pattern, line_updater, flags=0, abort_when_n
 
     if dry_run:
         printer.info('[DRY RUN] Updated {file_name} contents would be:'.format_map(f))
-        for j, line in enumerate(lines):
-            if i == j:
-                printer.error('-', original_line, sep='', end='')
-                printer.success('+', line, sep='', end='')
-            else:
-                print(' ', line, sep='', end='')
+        with open(file_name) as fp:
+            for j, line in enumerate(fp, 1):
+                if j == line_number:
+                    printer.error('-', original_line, sep='', end='')
+                    printer.success('+', updated_line, sep='', end='')
+                else:
+                    print(' ', line, sep='', end='')
         print('\n')
     else:
-        with open(file_name, 'w') as fp:
-            fp.writelines(lines)
         f = locals()
         printer.info('Updated line {line_number} of {file_name}'.format_map(f))
 
@@ -461,19 +539,19 @@ def find_and_update_changelog_header(changelog, version, release_date, **kwargs)
             hashes = ''
         return '{hashes}{version} - {release_date}'.format(hashes=hashes, **f)
 
-    header_re = CHANGELOG_HEADER_RE.format(version=re.escape(version))
+    header_pattern = changelog_header_pattern(version)
     not_found_message = '{changelog} appears to be missing a section for version {version}'
     not_found_message = not_found_message.format_map(f)
     found_changelog_header = find_and_update_line(
-        changelog, header_re, changelog_updater,
-        flags=re.I, not_found_message=not_found_message, abort_when_not_found=False,
-        **kwargs
+        changelog, header_pattern, changelog_updater,
+        not_found_message=not_found_message, abort_when_not_found=False,
+        must_contain=(version, 'next'), **kwargs
     )
 
     if not found_changelog_header:
         find_and_update_line(
-            changelog, FALLBACK_CHANGELOG_HEADER_RE, changelog_updater,
-            flags=re.I, not_found_message=not_found_message,
+            changelog, FALLBACK_CHANGELOG_HEADER_PATTERN, changelog_updater,
+            not_found_message=not_found_message, must_contain=('unreleased',),
             **kwargs
         )
 
@@ -498,31 +576,39 @@ def find_and_update_version(version, **kwargs):
     if os.path.isfile('VERSION'):
         version_file = 'VERSION'
 
-        find_and_update_line(
-            'VERSION',
-            r'.+',
-            lambda match, line: version,
-            not_found_message='No version found in VERSION file',
-            **kwargs
-        )
+        # The VERSION file contains only the version, so it's written
+        # directly rather than searched.
+        if kwargs.get('dry_run'):
+            printer.info('[DRY RUN] VERSION would be updated to {version}'.format_map(locals()))
+        else:
+            with open(version_file, 'w') as fp:
+                fp.write(version + '\n')
+            printer.info('Updated VERSION to {version}'.format_map(locals()))
     else:
         version_file = 'setup.py'
 
+        # Replacement templates for the matched VERSION global and
+        # version keyword arg; the original quote character is kept.
+        global_version_template = r'VERSION = \g<quote>%s\g<quote>' % version
+        version_arg_template = r'version=\g<quote>%s\g<quote>,' % version
+
         found = find_and_update_line(
             version_file,
-            SETUP_GLOBAL_VERSION_RE,
-            lambda match, line: match.expand(r'VERSION = \g<quote>%s\g<quote>' % version),
+            SETUP_GLOBAL_VERSION_PATTERN,
+            lambda match, line: match.expand(global_version_template),
             abort_when_not_found=False,
+            must_contain=('VERSION',),
             **kwargs
         )
 
         if not found:
             find_and_update_line(
                 version_file,
-                SETUP_VERSION_RE,
-                lambda match, line: match.expand(r'version=\g<quote>%s\g<quote>,' % version),
+                SETUP_VERSION_PATTERN,
+                lambda match, line: match.expand(version_arg_template),
                 not_found_message=(
                     'Could not find VERSION global in setup.py or version keyword arg in setup()'),
+                must_contain=('version=',),
                 **kwargs
             )
 
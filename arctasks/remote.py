@@ -1,10 +1,18 @@
+import gzip
 import os
-import string
+import posixpath
+import shlex
+import subprocess
+import tarfile
 import tempfile
+from contextlib import contextmanager
+from fnmatch import fnmatch
 
 from runcommands import command
 from runcommands.commands import local, remote
-from runcommands.util import abs_path, args_to_str
+from runcommands.util import abort, abs_path, args_to_str, printer
+
+from .util import render_template
 
 
 @command
@@ -18,19 +26,155 @@ def manage(config, args):
     ))
 
 
+_readlink_cache = {}
+
+
+def readlink(config, path):
+    """Get the target of the symlink at ``path`` on the remote host.
+
+    Targets are cached per host & path for the life of the process since
+    the same link (e.g., the active build link) is typically checked
+    several times while running a command. Call :func:`forget_readlink`
+    after changing a link.
+
+    Returns ``None`` if ``path`` isn't a symlink.
+
+    """
+    path = path.format_map(config)
+    key = (config.remote.host, path)
+    if key not in _readlink_cache:
+        result = remote(
+            config, ('readlink', path), echo=False, hide='all', abort_on_failure=False)
+        _readlink_cache[key] = (result.stdout.strip() or None) if result else None
+    return _readlink_cache[key]
+
+
+def cache_readlink(config, path, target):
+    """Record the ``target`` of a symlink that was read some other way."""
+    path = path.format_map(config)
+    _readlink_cache[(config.remote.host, path)] = target or None
+
+
+def forget_readlink(config, path):
+    """Remove the cached target of the symlink at ``path``."""
+    path = path.format_map(config)
+    _readlink_cache.pop((config.remote.host, path), None)
+
+
+def ssh_options(config):
+    """Get options that let SSH connections to a host share one master.
+
+    The first connection to a host becomes the master connection and
+    subsequent connections made while it's open (or until it times out
+    after ``remote.ssh.control_persist``) reuse it instead of doing a
+    full TCP connect, key exchange, and authentication.
+
+    """
+    return (
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={}'.format(config.remote.ssh.control_path),
+        '-o', 'ControlPersist={}'.format(config.remote.ssh.control_persist),
+    )
+
+
+@command
+def ssh_config(config, host=None):
+    """Show an ssh_config(5) entry for sharing connections to a host.
+
+    Connections made by ARCTasks itself (rsync, copy_tree, etc) always
+    share a master connection. Adding this entry to ``~/.ssh/config``
+    makes all other SSH connections to the host, including the ones used
+    to run remote commands, share it too.
+
+    """
+    host = host or config.remote.host
+    print('Host {host}'.format(host=host))
+    print('    ControlMaster auto')
+    print('    ControlPath {}'.format(config.remote.ssh.control_path))
+    print('    ControlPersist {}'.format(config.remote.ssh.control_persist))
+
+
+@contextmanager
+def master_connection(config, user=None, host=None):
+    """Hold a master connection to the remote host open.
+
+    SSH connections made with :func:`ssh_options` inside the ``with``
+    block reuse the master connection. This is useful for long running
+    commands (like deploy) that connect many times over a span longer
+    than ``remote.ssh.control_persist``.
+
+    If a master connection is already running (e.g., one kept alive by
+    ``ControlPersist``), it's reused and left running afterwards; only a
+    master connection opened here is closed on exit.
+
+    Failing to open the master connection isn't fatal since connections
+    will just be made normally.
+
+    """
+    user = user or config.remote.user
+    host = host or config.remote.host
+    destination = '{user}@{host}'.format_map(locals())
+    ssh_args = ['ssh']
+    ssh_args.extend(ssh_options(config))
+
+    running = subprocess.call(
+        ssh_args + ['-O', 'check', destination], stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    if running:
+        opened = False
+    else:
+        opened = subprocess.call(
+            ssh_args + ['-f', '-N', '-M', destination], stdin=subprocess.DEVNULL) == 0
+    try:
+        yield running or opened
+    finally:
+        if opened:
+            subprocess.call(
+                ssh_args + ['-O', 'exit', destination],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
 _rsync_default_mode = 'ug=rwX,o-rwx'
 
 
 @command
 def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run_as=None,
           dry_run=False, delete=False, excludes=(), default_excludes=True, quiet=False,
-          echo=True, hide=None, mode=_rsync_default_mode, source='local'):
+          echo=True, hide=None, mode=_rsync_default_mode, source='local', whole_file=False,
+          files_from=None, copy_dest=None, link_dest=None, compress=True, checksum=False):
     """Copy files using rsync.
 
     By default, this pushes from ``local_path`` to ``remote_path``. To
     invert this--to pull from the remote to the local path--, pass
     ``source='remote'``.
 
+    Pass ``whole_file=True`` to skip rsync's delta-transfer algorithm.
+    This is faster when the files being copied are new or have changed
+    completely, since there's nothing on the other end to diff against.
+
+    Pass ``files_from`` (the path to a file containing a list of paths
+    relative to the source path, one per line) to copy only those files.
+    This also saves rsync from having to walk the source path when the
+    caller already knows which files need to be copied.
+
+    Pass ``copy_dest`` (an absolute path to a similar directory on the
+    destination host) to have files that are unchanged relative to that
+    directory copied locally on the destination host instead of being
+    transferred. Changed files are transferred as deltas against their
+    counterparts in ``copy_dest``. ``link_dest`` works the same way,
+    except that unchanged files are hard linked instead of copied, so
+    they don't take up any additional space.
+
+    By default, files are considered unchanged when their sizes and
+    modification times match. Pass ``checksum=True`` to compare their
+    contents instead. This is useful when files are regenerated with
+    new modification times but the same contents; the cost is that
+    every file is read on both ends to compute its checksum.
+
+    Data is compressed in transit by default (rsync skips compressing
+    files that are already compressed, like tarballs and images). Pass
+    ``compress=False`` to disable compression, e.g. on a fast network.
+
     """
     remote_path = '{user}@{host}:{remote_path}'.format_map(locals())
 
@@ -60,10 +204,17 @@ def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run
 
     local(config, (
         'rsync',
-        '-rltvz',
+        '-rltv',
+        '--compress' if compress else '',
         '--quiet' if quiet else '',
         '--dry-run' if dry_run else '',
         '--delete' if delete else '',
+        '--whole-file' if whole_file else '',
+        '--checksum' if checksum else '',
+        ('--files-from', files_from) if files_from else '',
+        ('--copy-dest', copy_dest) if copy_dest else '',
+        ('--link-dest', link_dest) if link_dest else '',
+        ('-e', '"ssh {}"'.format(' '.join(ssh_options(config)))),
         rsync_path,
         '--no-perms', '--no-group', '--chmod=%s' % mode,
         exclude_from,
@@ -76,19 +227,11 @@ def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run
 def copy_file(config, local_path, remote_path, user=None, host=None, sudo=False, run_as=None,
               quiet=False, template=False, template_type=None, mode=_rsync_default_mode):
     local_path = abs_path(local_path, format_kwargs=config)
-    rsync_args = dict(user=user, host=host, sudo=sudo, run_as=run_as, quiet=quiet, mode=mode)
+    rsync_args = dict(
+        user=user, host=host, sudo=sudo, run_as=run_as, quiet=quiet, mode=mode, whole_file=True)
 
     if template:
-        with open(local_path) as in_fp:
-            contents = in_fp.read()
-
-        if template_type in (None, 'format'):
-            contents = contents.format_map(config)
-        elif template_type == 'string':
-            template = string.Template(contents)
-            contents = template.substitute(config)
-        else:
-            raise ValueError('Unrecognized template type: %s' % template_type)
+        contents = render_template(config, local_path, template_type)
 
         prefix = '%s-' % config.package
         suffix = '-%s' % os.path.basename(local_path)
@@ -101,3 +244,107 @@ def copy_file(config, local_path, remote_path, user=None, host=None, sudo=False,
         os.remove(temp_path)
     else:
         rsync(config, local_path, remote_path, **rsync_args)
+
+
+_copy_tree_chunk_size = 1024 * 1024
+_copy_tree_compress_level = 6
+
+
+@command
+def copy_tree(config, local_path, remote_path, user=None, host=None, sudo=False, run_as=None,
+              arcname=None, paths=None, excludes=(), default_excludes=True, quiet=False):
+    """Copy a directory tree to the remote host as a single tar stream.
+
+    The tree is tarred and gzipped on the fly and piped over one SSH
+    connection into ``tar`` on the remote host, so no local archive is
+    written and no separate extraction command is needed. This is much
+    faster than :func:`rsync` when copying a lot of small files to a
+    fresh directory since there's no per-file protocol overhead.
+
+    The tree is extracted into ``remote_path`` (which will be created if
+    necessary). By default, the tree's contents are extracted directly
+    into ``remote_path``; pass ``arcname`` to extract them into a
+    subdirectory of ``remote_path`` instead.
+
+    Pass ``paths`` (a list of file paths relative to ``local_path``) to
+    copy only those files. Otherwise, the whole tree is copied.
+
+    ``excludes`` and ``default_excludes`` work like they do for
+    :func:`rsync`, except that patterns are only matched against
+    individual path components (directory patterns end with a slash).
+    Extracted files are given the same permissions as files copied by
+    :func:`rsync` (ug=rwX,o-rwx).
+
+    """
+    local_path = abs_path(local_path, format_kwargs=config)
+    remote_path = remote_path.format_map(config)
+    arcname = '.' if arcname is None else arcname.format_map(config)
+
+    excludes = list(excludes)
+    if default_excludes:
+        with open(abs_path('arctasks:rsync.excludes')) as excludes_fp:
+            excludes.extend(line.strip() for line in excludes_fp if line.strip())
+
+    def exclude_filter(tar_info):
+        parts = tar_info.name.split('/')
+        dir_parts = parts if tar_info.isdir() else parts[:-1]
+        for pattern in excludes:
+            if pattern.endswith('/'):
+                if any(fnmatch(part, pattern[:-1]) for part in dir_parts):
+                    return None
+            elif fnmatch(parts[-1], pattern):
+                return None
+        # Apply ug=rwX,o-rwx to the archived mode so files are extracted
+        # with the right permissions and don't need to be fixed up later.
+        mode = (tar_info.mode | 0o660) & ~0o007
+        if tar_info.isdir() or mode & 0o111:
+            mode |= 0o110
+        tar_info.mode = mode
+        return tar_info
+
+    extract_command = 'umask 007 && mkdir -p {path} && tar xzf - -C {path}'.format(
+        path=shlex.quote(remote_path))
+    if sudo:
+        extract_command = 'sudo sh -c {cmd}'.format(cmd=shlex.quote(extract_command))
+    elif run_as and run_as != user:
+        run_as = args_to_str(run_as, format_kwargs=config)
+        extract_command = 'sudo -u {run_as} sh -c {cmd}'.format(
+            run_as=run_as, cmd=shlex.quote(extract_command))
+
+    if not quiet:
+        printer.info('Streaming {local_path} to {host}:{remote_path}...'.format_map(locals()))
+
+    ssh_args = ['ssh']
+    ssh_args.extend(ssh_options(config))
+    ssh_args.extend(('{user}@{host}'.format_map(locals()), extract_command))
+    # The tar stream is written to ssh in large chunks. The pipe itself
+    # is unbuffered since tarfile already does the buffering. tarfile's
+    # own streaming gzip support always uses the maximum compression
+    # level, which is much slower for little gain, so the compression is
+    # done separately.
+    process = subprocess.Popen(ssh_args, stdin=subprocess.PIPE, bufsize=0)
+    try:
+        with gzip.GzipFile(
+                fileobj=process.stdin, mode='wb',
+                compresslevel=_copy_tree_compress_level) as gzip_stream:
+            with tarfile.open(
+                    fileobj=gzip_stream, mode='w|', bufsize=_copy_tree_chunk_size) as tarball:
+                if paths is None and arcname == '.':
+                    # The top level directory itself isn't archived so
+                    # extracting doesn't change the permissions or mtime
+                    # of an existing remote directory.
+                    for name in sorted(os.listdir(local_path)):
+                        tarball.add(os.path.join(local_path, name), name, filter=exclude_filter)
+                elif paths is None:
+                    tarball.add(local_path, arcname, filter=exclude_filter)
+                else:
+                    for path in paths:
+                        tarball.add(
+                            os.path.join(local_path, path), posixpath.join(arcname, path),
+                            recursive=False, filter=exclude_filter)
+    finally:
+        process.stdin.close()
+        return_code = process.wait()
+
+    if return_code:
+        abort(return_code, 'Failed to copy {local_path} to {remote_path}'.format_map(locals()))
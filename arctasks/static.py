@@ -153,7 +153,7 @@ _collectstatic_default_ignore = (
 
 @command(default_env='dev')
 def collectstatic(config, static_root=None, default_ignore=True, ignore=(), exclude=(), include=(),
-                  echo=False, hide=None):
+                  clear=True, echo=False, hide=None):
     settings = get_settings(config)
     override_static_root = bool(static_root)
 
@@ -180,7 +180,7 @@ def collectstatic(config, static_root=None, default_ignore=True, ignore=(), excl
     args = {
         'interactive': False,
         'ignore': ignore,
-        'clear': True,
+        'clear': clear,
         'hide': hide,
     }
 
@@ -1,3 +1,6 @@
+import os
+import string
+from functools import lru_cache
 from glob import glob
 
 from runcommands.util import abort, abs_path
@@ -12,3 +15,49 @@ def flatten_globs(config, sources, check_exists=True):
             abort(1, 'No sources found for "{source}"'.format(source=source))
         flattened_sources.extend(paths)
     return flattened_sources
+
+
+def list_files(path):
+    """List the files in the directory tree at ``path``.
+
+    Paths are relative to ``path`` and are returned in walk order.
+
+    """
+    files = []
+    for dir_path, _, file_names in os.walk(path):
+        rel_dir_path = os.path.relpath(dir_path, path)
+        if rel_dir_path == os.curdir:
+            files.extend(file_names)
+        else:
+            files.extend(os.path.join(rel_dir_path, name) for name in file_names)
+    return files
+
+
+def render_template(config, path, template_type=None):
+    """Render the template at ``path`` using ``config``.
+
+    ``template_type`` can be either 'format' (the default), which uses
+    :meth:`str.format_map`, or 'string', which uses
+    :class:`string.Template`.
+
+    Template sources are cached (and reloaded if they change on disk),
+    so rendering the same template repeatedly only reads it once.
+
+    """
+    contents = _read_template(path, os.path.getmtime(path))
+    if template_type in (None, 'format'):
+        return contents.format_map(config)
+    elif template_type == 'string':
+        return _make_string_template(contents).substitute(config)
+    raise ValueError('Unrecognized template type: %s' % template_type)
+
+
+@lru_cache(maxsize=32)
+def _read_template(path, mtime):
+    with open(path) as in_fp:
+        return in_fp.read()
+
+
+@lru_cache(maxsize=32)
+def _make_string_template(contents):
+    return string.Template(contents)